@@ -1,16 +1,248 @@
-from fastapi import FastAPI
+import argparse
+import base64
+import bisect
+import codecs
+import csv
+import datetime
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+from decimal import Decimal
+from typing import List, Optional
+
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 import psycopg2
-from pydantic import BaseModel
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.pool
+from pydantic import BaseModel, Field
+from starlette.datastructures import Headers, MutableHeaders
 
-# FastAPI app
-app = FastAPI()
+try:
+    # psycopg 3 is only needed for DB_ENGINE=async
+    import psycopg
+    import psycopg_pool
+except ImportError:
+    psycopg = None
+    psycopg_pool = None
+
+try:
+    # faster JSON encoding for big listings, the json module is used without it
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    # only needed to answer clients that send Accept: application/msgpack
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    # only needed to answer product listings as an Arrow IPC stream
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+try:
+    # br is offered next to gzip when the brotli package is installed
+    import brotli
+except ImportError:
+    brotli = None
+
+# Database connection info (can be overridden with environment variables, e.g. by Benchmark.py)
+DB_NAME = os.getenv("DB_NAME", "postgres")
+DB_USER = os.getenv("DB_USER", "postgres")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "12345")
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_PORT = os.getenv("DB_PORT", "5442")
+
+# Connection pool settings (can be overridden with environment variables)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "2"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))  # seconds to wait for a free connection
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTHCHECK_INTERVAL", "30"))  # ping idle connections older than this
+
+# rows fetched per round trip by /export_products/
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "2000"))
+
+# rows validated and copied per transaction by /import_products/
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "5000"))
+IMPORT_MAX_ERRORS = 1000  # errors listed in the response, the rest are only counted
+
+# in-process response cache for the read endpoints, CACHE_MAX_ENTRIES=0 turns it off
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))  # seconds, also bounds staleness between several workers
+# entries are whole encoded responses (an unpaged listing is the full catalog), so their total size is capped too
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# "sync": psycopg2 in Starlette's threadpool, "async": psycopg 3 on the event loop
+DB_ENGINE = os.getenv("DB_ENGINE", "sync")
+
+# responses of at least this many bytes are compressed (gzip, or br with brotli) for clients that accept it
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))  # brotli's default 11 is too slow per request
+# compressed catalog reads kept so a repeated listing isn't compressed again, 0 turns it off
+COMPRESSION_CACHE_MAX_BYTES = int(os.getenv("COMPRESSION_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# queries slower than this are logged with their SQL, 0 turns the slow query log off
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "0"))
+
+logger = logging.getLogger("Back_end")
+
+
+#.......METRICS...............
+
+# histogram buckets in seconds, from a cached read to a slow import chunk
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)   # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+class Metrics:
+    """Counters and histograms kept in process, rendered in the Prometheus text format by /metrics"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.histograms = {}   # (name, labels) -> Histogram
+        self.counters = {}     # (name, labels) -> value
 
-# Database connection info
-DB_NAME = "postgres"
-DB_USER = "postgres"
-DB_PASSWORD = "12345"
-DB_HOST = "localhost"
-DB_PORT = "5442"
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self, gauges=()):
+        """gauges: (name, labels, value) read at scrape time, e.g. pool and cache stats"""
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+
+        seen = set()
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                lines.append(f"# TYPE {name} histogram")
+                seen.add(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        for (name, labels), value in counters:
+            if name not in seen:
+                lines.append(f"# TYPE {name} counter")
+                seen.add(name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for name, labels, value in gauges:
+            if name not in seen:
+                lines.append(f"# TYPE {name} gauge")
+                seen.add(name)
+            lines.append(f"{name}{format_labels(tuple(sorted(labels.items())))} {value}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+        for key, value in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+metrics = Metrics()
+
+# label cache: the same few SQL strings run over and over
+_query_labels = {}
+
+def query_label(sql):
+    """Short stable name for a statement: operation, first table and a hash of the normalized SQL"""
+    label = _query_labels.get(sql)
+    if label is None:
+        normalized = " ".join(str(sql).split())
+        operation = normalized.split(" ", 1)[0].upper() if normalized else "?"
+        table = re.search(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF (?:NOT )?EXISTS\s+)?([A-Za-z_]\w*)", normalized, re.IGNORECASE)
+        digest = hashlib.sha1(normalized.encode()).hexdigest()[:6]
+        label = f"{operation} {table.group(1) if table else '-'} {digest}"
+        if len(_query_labels) < 1000:
+            _query_labels[sql] = label
+    return label
+
+def record_query(sql, duration, rows):
+    # rowcount is -1 for statements without a result and for server side cursors before they are fetched
+    rows = max(rows, 0)
+    label = query_label(sql)
+    metrics.observe("db_query_duration_seconds", duration, query=label)
+    metrics.inc("db_query_rows_total", rows, query=label)
+    if DB_SLOW_QUERY_MS and duration * 1000 >= DB_SLOW_QUERY_MS:
+        metrics.inc("db_slow_queries_total", query=label)
+        logger.warning("slow query %.1f ms, %d rows [%s]: %s", duration * 1000, rows, label,
+                       " ".join(str(sql).split())[:1000])
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """psycopg2 cursor that records every statement's time and row count"""
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(query, time.perf_counter() - start, self.rowcount)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record_query(sql, time.perf_counter() - start, self.rowcount)
+
+if psycopg is not None:
+    class TimedAsyncCursor(psycopg.AsyncCursor):
+        """The same for psycopg 3, conn.execute() goes through the connection's cursor_factory"""
+        async def execute(self, query, params=None, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await super().execute(query, params, **kwargs)
+            finally:
+                record_query(query, time.perf_counter() - start, self.rowcount)
 
 
 #........CLASSES (BaseModels)............
@@ -22,50 +254,875 @@ class Product(BaseModel):
     product_stock: int
 
 
+# product_id and product_stock are INT columns
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
 
-#.......FUNCTIONS TO HANDLE DATABASE...............
+class RestockItem(BaseModel):
+    product_id: int = Field(ge=INT_MIN, le=INT_MAX)
+    stock_delta: int = Field(ge=INT_MIN, le=INT_MAX)
 
-def get_connection(DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT):
-    try:
-        conn=psycopg2.connect(
-                database=DB_NAME,
-                user=DB_USER,
-                password=DB_PASSWORD,
-                host=DB_HOST,
-                port=DB_PORT
-        )
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became free within the acquire timeout"""
+
+class VersionConflict(Exception):
+    """Raised when a product changed since the version the client based its update on"""
+    def __init__(self, current_version):
+        super().__init__(f"Product was modified, current version is {current_version}")
+        self.current_version = current_version
+
+
+#the ConnectionPool keeps a set of open connections that are reused by every request
+class ConnectionPool:
+    def __init__(self, minconn, maxconn, timeout, healthcheck_interval, **conn_kwargs):
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **conn_kwargs)
+        # ThreadedConnectionPool fails immediately when exhausted, so the semaphore makes callers wait instead
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+
+        # metrics
+        self.in_use = 0
+        self.acquired = 0
+        self.timeouts = 0
+        self.replaced = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn), 0)
+        if time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        conn = self._pool.getconn()
+        if not self._is_healthy(conn):
+            self._last_used.pop(id(conn), None)
+            self._pool.putconn(conn, close=True)
+            with self._lock:
+                self.replaced += 1
+            conn = self._pool.getconn()
         return conn
-    except psycopg2.Error as e:
-        print("Error connecting: ",e)
-        return None
 
-def insert_product_to_db(product: Product):
-    conn=get_connection(DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT)
-    cursor = conn.cursor()
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS products (
-        product_id SERIAL PRIMARY KEY,
-        product_name VARCHAR(100),
-        product_description VARCHAR(500),
-        product_price DOUBLE PRECISION,
-        product_stock INT
-    );
-    """)
-
-    cursor.execute("""
+    @contextmanager
+    def connection(self):
+        """Borrow a connection from the pool, it always goes back when the block ends"""
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+        waited = time.perf_counter() - start
+
+        try:
+            conn = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self.in_use += 1
+            self.acquired += 1
+            self.wait_time_total += waited
+            self.wait_time_max = max(self.wait_time_max, waited)
+        metrics.observe("db_pool_acquire_seconds", time.perf_counter() - start, pool="sync")
+
+        try:
+            yield conn
+        finally:
+            discard = bool(conn.closed)
+            try:
+                # never hand out a connection that is still inside a transaction
+                if not discard and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                # a connection that can't even roll back (the server went away) is closed, not reused
+                discard = True
+            try:
+                if discard:
+                    self._last_used.pop(id(conn), None)
+                else:
+                    self._last_used[id(conn)] = time.monotonic()
+                self._pool.putconn(conn, close=discard)
+            finally:
+                # the slot always comes back, or every leak would permanently shrink the pool
+                with self._lock:
+                    self.in_use -= 1
+                self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "in_use": self.in_use,
+                "saturation": self.in_use / self.maxconn,
+                "acquired_total": self.acquired,
+                "acquire_timeouts": self.timeouts,
+                "replaced_connections": self.replaced,
+                "wait_time_avg": self.wait_time_total / self.acquired if self.acquired else 0.0,
+                "wait_time_max": self.wait_time_max,
+            }
+
+    def close(self):
+        self._pool.closeall()
+
+
+#.......CONNECTION POOL...............
+
+db_pool = None
+
+def open_pool():
+    global db_pool
+    db_pool = ConnectionPool(
+        DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_INTERVAL,
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        host=DB_HOST,
+        port=DB_PORT,
+        cursor_factory=TimedCursor,
+    )
+    return db_pool
+
+def close_pool():
+    global db_pool
+    if db_pool is not None:
+        db_pool.close()
+        db_pool = None
+
+
+#the AsyncConnectionPool wraps psycopg_pool so both engines report the same errors and metrics
+class AsyncConnectionPool:
+    def __init__(self, minconn, maxconn, timeout, conninfo):
+        if psycopg_pool is None:
+            raise RuntimeError("DB_ENGINE=async needs the 'psycopg' and 'psycopg_pool' packages")
+        # psycopg_pool already discards connections that come back broken
+        self._pool = psycopg_pool.AsyncConnectionPool(
+            conninfo,
+            min_size=minconn,
+            max_size=maxconn,
+            timeout=timeout,
+            open=False,
+            kwargs={"cursor_factory": TimedAsyncCursor},
+        )
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+
+    async def open(self):
+        await self._pool.open(wait=True)
+
+    @asynccontextmanager
+    async def connection(self):
+        """Borrow a connection, commits when the block succeeds and rolls back on errors"""
+        start = time.perf_counter()
+        try:
+            async with self._pool.connection() as conn:
+                metrics.observe("db_pool_acquire_seconds", time.perf_counter() - start, pool="async")
+                yield conn
+        except psycopg_pool.PoolTimeout:
+            raise PoolTimeout(f"No database connection available after {self.timeout}s")
+
+    def stats(self):
+        stats = self._pool.get_stats()
+        in_use = stats.get("pool_size", 0) - stats.get("pool_available", 0)
+        acquired = stats.get("requests_num", 0)
+        return {
+            "min_size": self.minconn,
+            "max_size": self.maxconn,
+            "in_use": in_use,
+            "saturation": in_use / self.maxconn,
+            "acquired_total": acquired,
+            "acquire_timeouts": stats.get("requests_errors", 0),
+            "replaced_connections": stats.get("connections_lost", 0),
+            "wait_time_avg": stats.get("requests_wait_ms", 0) / 1000 / acquired if acquired else 0.0,
+            "wait_time_max": None,
+        }
+
+    async def close(self):
+        await self._pool.close()
+
+async_db_pool = None
+
+async def open_async_pool():
+    global async_db_pool
+    conninfo = psycopg.conninfo.make_conninfo(
+        dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT
+    )
+    async_db_pool = AsyncConnectionPool(
+        DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, conninfo
+    )
+    await async_db_pool.open()
+    return async_db_pool
+
+async def close_async_pool():
+    global async_db_pool
+    if async_db_pool is not None:
+        await async_db_pool.close()
+        async_db_pool = None
+
+#.......DATABASE SCHEMA (MIGRATIONS)...............
+
+# Each migration runs once, in order, and is recorded in schema_migrations.
+# To change the schema append a new (version, description, sql) entry, never edit an old one.
+MIGRATIONS = [
+    (1, "create products table", """
+        CREATE TABLE IF NOT EXISTS products (
+            product_id SERIAL PRIMARY KEY,
+            product_name VARCHAR(100),
+            product_description VARCHAR(500),
+            product_price DOUBLE PRECISION,
+            product_stock INT
+        );
+    """),
+    (2, "indexes for searches and stock queries", """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE INDEX IF NOT EXISTS products_name_trgm_idx
+            ON products USING gin (product_name gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS products_description_trgm_idx
+            ON products USING gin (product_description gin_trgm_ops);
+        CREATE INDEX IF NOT EXISTS products_stock_idx ON products (product_stock);
+    """),
+    (3, "keyset pagination indexes", """
+        CREATE INDEX IF NOT EXISTS products_name_id_idx ON products (product_name, product_id);
+        CREATE INDEX IF NOT EXISTS products_price_id_idx ON products (product_price, product_id);
+        CREATE INDEX IF NOT EXISTS products_stock_id_idx ON products (product_stock, product_id);
+        -- (product_stock, product_id) also serves every query products_stock_idx did
+        DROP INDEX IF EXISTS products_stock_idx;
+    """),
+    (4, "product_stats summary maintained by triggers", """
+        LOCK TABLE products IN SHARE ROW EXCLUSIVE MODE;
+
+        -- single row table, sums are NUMERIC so adding and removing a row cancels out exactly
+        CREATE TABLE IF NOT EXISTS product_stats (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            product_count BIGINT NOT NULL,
+            price_count BIGINT NOT NULL,
+            price_sum NUMERIC NOT NULL,
+            stock_count BIGINT NOT NULL,
+            stock_sum NUMERIC NOT NULL,
+            value_sum NUMERIC NOT NULL,
+            available_products BIGINT NOT NULL,
+            out_of_stock_products BIGINT NOT NULL
+        );
+
+        INSERT INTO product_stats
+        SELECT TRUE, COUNT(*), COUNT(product_price), COALESCE(SUM(product_price::NUMERIC), 0),
+               COUNT(product_stock), COALESCE(SUM(product_stock), 0),
+               COALESCE(SUM((product_price * product_stock)::NUMERIC), 0),
+               COUNT(*) FILTER (WHERE product_stock > 0), COUNT(*) FILTER (WHERE product_stock <= 0)
+        FROM products
+        ON CONFLICT (id) DO NOTHING;
+
+        CREATE OR REPLACE FUNCTION product_stats_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                UPDATE product_stats SET product_count = 0, price_count = 0, price_sum = 0, stock_count = 0,
+                    stock_sum = 0, value_sum = 0, available_products = 0, out_of_stock_products = 0;
+                RETURN NULL;
+            END IF;
+
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                UPDATE product_stats s SET
+                    product_count = s.product_count - d.product_count,
+                    price_count = s.price_count - d.price_count,
+                    price_sum = s.price_sum - d.price_sum,
+                    stock_count = s.stock_count - d.stock_count,
+                    stock_sum = s.stock_sum - d.stock_sum,
+                    value_sum = s.value_sum - d.value_sum,
+                    available_products = s.available_products - d.available_products,
+                    out_of_stock_products = s.out_of_stock_products - d.out_of_stock_products
+                FROM (
+                    SELECT COUNT(*) AS product_count, COUNT(product_price) AS price_count,
+                           COALESCE(SUM(product_price::NUMERIC), 0) AS price_sum,
+                           COUNT(product_stock) AS stock_count, COALESCE(SUM(product_stock), 0) AS stock_sum,
+                           COALESCE(SUM((product_price * product_stock)::NUMERIC), 0) AS value_sum,
+                           COUNT(*) FILTER (WHERE product_stock > 0) AS available_products,
+                           COUNT(*) FILTER (WHERE product_stock <= 0) AS out_of_stock_products
+                    FROM old_rows
+                ) d
+                WHERE d.product_count > 0;
+            END IF;
+
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                UPDATE product_stats s SET
+                    product_count = s.product_count + d.product_count,
+                    price_count = s.price_count + d.price_count,
+                    price_sum = s.price_sum + d.price_sum,
+                    stock_count = s.stock_count + d.stock_count,
+                    stock_sum = s.stock_sum + d.stock_sum,
+                    value_sum = s.value_sum + d.value_sum,
+                    available_products = s.available_products + d.available_products,
+                    out_of_stock_products = s.out_of_stock_products + d.out_of_stock_products
+                FROM (
+                    SELECT COUNT(*) AS product_count, COUNT(product_price) AS price_count,
+                           COALESCE(SUM(product_price::NUMERIC), 0) AS price_sum,
+                           COUNT(product_stock) AS stock_count, COALESCE(SUM(product_stock), 0) AS stock_sum,
+                           COALESCE(SUM((product_price * product_stock)::NUMERIC), 0) AS value_sum,
+                           COUNT(*) FILTER (WHERE product_stock > 0) AS available_products,
+                           COUNT(*) FILTER (WHERE product_stock <= 0) AS out_of_stock_products
+                    FROM new_rows
+                ) d
+                WHERE d.product_count > 0;
+            END IF;
+            RETURN NULL;
+        END;
+        $$;
+
+        -- statement level triggers see all changed rows at once, so bulk writes update the summary once
+        CREATE TRIGGER product_stats_insert AFTER INSERT ON products
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION product_stats_apply();
+        CREATE TRIGGER product_stats_update AFTER UPDATE ON products
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION product_stats_apply();
+        CREATE TRIGGER product_stats_delete AFTER DELETE ON products
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION product_stats_apply();
+        CREATE TRIGGER product_stats_truncate AFTER TRUNCATE ON products
+            FOR EACH STATEMENT EXECUTE FUNCTION product_stats_apply();
+    """),
+    (5, "full text search column", """
+        -- 'simple' config: product names are not natural language, so no stemming or stop words
+        ALTER TABLE products ADD COLUMN IF NOT EXISTS product_search TSVECTOR
+            GENERATED ALWAYS AS (
+                setweight(to_tsvector('simple', coalesce(product_name, '')), 'A') ||
+                setweight(to_tsvector('simple', coalesce(product_description, '')), 'B')
+            ) STORED;
+        CREATE INDEX IF NOT EXISTS products_search_idx ON products USING gin (product_search);
+    """),
+    (6, "catalog version counter", """
+        -- bumped by every statement that writes products, read endpoints derive their ETag from it
+        ALTER TABLE product_stats ADD COLUMN IF NOT EXISTS catalog_version BIGINT NOT NULL DEFAULT 0;
+
+        CREATE OR REPLACE FUNCTION product_catalog_version_bump() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            UPDATE product_stats SET catalog_version = catalog_version + 1;
+            RETURN NULL;
+        END;
+        $$;
+
+        CREATE TRIGGER product_catalog_version AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON products
+            FOR EACH STATEMENT EXECUTE FUNCTION product_catalog_version_bump();
+    """),
+    (7, "change sequence and tombstones for delta sync", """
+        LOCK TABLE products IN SHARE ROW EXCLUSIVE MODE;
+
+        -- existing rows each get their own number, so a client starting from 0 receives all of them
+        CREATE SEQUENCE IF NOT EXISTS product_change_seq;
+        ALTER TABLE products
+            ADD COLUMN IF NOT EXISTS change_seq BIGINT NOT NULL DEFAULT nextval('product_change_seq'),
+            ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+        CREATE INDEX IF NOT EXISTS products_change_seq_idx ON products (change_seq);
+
+        CREATE TABLE IF NOT EXISTS product_tombstones (
+            product_id INT PRIMARY KEY,
+            change_seq BIGINT NOT NULL,
+            deleted_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS product_tombstones_change_seq_idx ON product_tombstones (change_seq);
+
+        -- a TRUNCATE leaves no tombstones, clients that synced before this number have to reload
+        ALTER TABLE product_stats ADD COLUMN IF NOT EXISTS changes_floor BIGINT NOT NULL DEFAULT 0;
+
+        -- writers already queue on the product_stats row until they commit, taking it before any row
+        -- is stamped makes change numbers follow commit order, so no reader can skip a late commit
+        CREATE OR REPLACE FUNCTION product_changes_lock() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM 1 FROM product_stats FOR UPDATE;
+            RETURN NULL;
+        END;
+        $$;
+
+        CREATE OR REPLACE FUNCTION product_change_stamp() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW.change_seq := nextval('product_change_seq');
+            NEW.updated_at := now();
+            RETURN NEW;
+        END;
+        $$;
+
+        CREATE OR REPLACE FUNCTION product_tombstones_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                DELETE FROM product_tombstones;
+                UPDATE product_stats SET changes_floor = nextval('product_change_seq');
+                RETURN NULL;
+            END IF;
+
+            INSERT INTO product_tombstones (product_id, change_seq)
+            SELECT product_id, nextval('product_change_seq') FROM old_rows
+            ON CONFLICT (product_id) DO UPDATE SET change_seq = EXCLUDED.change_seq, deleted_at = now();
+            RETURN NULL;
+        END;
+        $$;
+
+        CREATE TRIGGER product_changes_lock BEFORE INSERT OR UPDATE OR DELETE OR TRUNCATE ON products
+            FOR EACH STATEMENT EXECUTE FUNCTION product_changes_lock();
+        CREATE TRIGGER product_change_stamp BEFORE INSERT OR UPDATE ON products
+            FOR EACH ROW EXECUTE FUNCTION product_change_stamp();
+        CREATE TRIGGER product_tombstones_delete AFTER DELETE ON products
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION product_tombstones_apply();
+        CREATE TRIGGER product_tombstones_truncate AFTER TRUNCATE ON products
+            FOR EACH STATEMENT EXECUTE FUNCTION product_tombstones_apply();
+    """),
+    (8, "catalog version only bumped by statements that changed rows", """
+        -- a statement that matched nothing (a stale If-Match, a missing id) leaves every ETag valid
+        CREATE OR REPLACE FUNCTION product_catalog_version_bump() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP <> 'TRUNCATE' THEN
+                IF NOT EXISTS (SELECT 1 FROM changed_rows) THEN
+                    RETURN NULL;
+                END IF;
+            END IF;
+            UPDATE product_stats SET catalog_version = catalog_version + 1;
+            RETURN NULL;
+        END;
+        $$;
+
+        -- transition tables can only be declared on single event triggers
+        DROP TRIGGER IF EXISTS product_catalog_version ON products;
+        CREATE TRIGGER product_catalog_version_insert AFTER INSERT ON products
+            REFERENCING NEW TABLE AS changed_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION product_catalog_version_bump();
+        CREATE TRIGGER product_catalog_version_update AFTER UPDATE ON products
+            REFERENCING NEW TABLE AS changed_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION product_catalog_version_bump();
+        CREATE TRIGGER product_catalog_version_delete AFTER DELETE ON products
+            REFERENCING OLD TABLE AS changed_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION product_catalog_version_bump();
+        CREATE TRIGGER product_catalog_version_truncate AFTER TRUNCATE ON products
+            FOR EACH STATEMENT EXECUTE FUNCTION product_catalog_version_bump();
+    """),
+    (9, "writers no longer queue on product_stats: change positions by transaction, stats as deltas", """
+        LOCK TABLE products IN SHARE ROW EXCLUSIVE MODE;
+
+        DROP TRIGGER IF EXISTS product_changes_lock ON products;
+        DROP FUNCTION IF EXISTS product_changes_lock();
+
+        -- a change's position is (writing transaction, change_seq). Readers only hand out positions of
+        -- transactions older than their snapshot's xmin, which have all finished, so a transaction that
+        -- commits late is never skipped. Rows from before this migration count as transaction 0
+        ALTER TABLE products ADD COLUMN IF NOT EXISTS change_xid BIGINT NOT NULL DEFAULT 0;
+        ALTER TABLE product_tombstones ADD COLUMN IF NOT EXISTS change_xid BIGINT NOT NULL DEFAULT 0;
+        CREATE INDEX IF NOT EXISTS products_change_position_idx ON products (change_xid, change_seq);
+        CREATE INDEX IF NOT EXISTS product_tombstones_change_position_idx
+            ON product_tombstones (change_xid, change_seq);
+        DROP INDEX IF EXISTS products_change_seq_idx;
+        DROP INDEX IF EXISTS product_tombstones_change_seq_idx;
+        -- floors were change numbers, from now on they are transaction ids
+        UPDATE product_stats SET changes_floor = 0;
+
+        CREATE OR REPLACE FUNCTION product_change_stamp() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            NEW.change_seq := nextval('product_change_seq');
+            NEW.change_xid := pg_current_xact_id()::TEXT::BIGINT;
+            NEW.updated_at := now();
+            RETURN NEW;
+        END;
+        $$;
+
+        CREATE OR REPLACE FUNCTION product_tombstones_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                DELETE FROM product_tombstones;
+                UPDATE product_stats SET changes_floor = pg_current_xact_id()::TEXT::BIGINT;
+                RETURN NULL;
+            END IF;
+
+            IF TG_OP = 'INSERT' THEN
+                -- an id inserted again: its row holds the latest change, and positions don't follow commit
+                -- order, so an older tombstone could otherwise be read after it
+                DELETE FROM product_tombstones t USING new_rows n WHERE t.product_id = n.product_id;
+                RETURN NULL;
+            END IF;
+
+            INSERT INTO product_tombstones (product_id, change_seq, change_xid)
+            SELECT product_id, nextval('product_change_seq'), pg_current_xact_id()::TEXT::BIGINT FROM old_rows
+            ON CONFLICT (product_id) DO UPDATE
+                SET change_seq = EXCLUDED.change_seq, change_xid = EXCLUDED.change_xid, deleted_at = now();
+            RETURN NULL;
+        END;
+        $$;
+
+        CREATE TRIGGER product_tombstones_insert AFTER INSERT ON products
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION product_tombstones_apply();
+
+        -- every write statement appends one row here instead of updating the product_stats row, so
+        -- writers never wait on each other. A row is that statement's change to the sums and one
+        -- catalog version; readers add them up (product_stats_current) and now and then they are folded in
+        CREATE TABLE IF NOT EXISTS product_stats_deltas (
+            delta_id BIGSERIAL PRIMARY KEY,
+            catalog_version BIGINT NOT NULL,
+            product_count BIGINT NOT NULL,
+            price_count BIGINT NOT NULL,
+            price_sum NUMERIC NOT NULL,
+            stock_count BIGINT NOT NULL,
+            stock_sum NUMERIC NOT NULL,
+            value_sum NUMERIC NOT NULL,
+            available_products BIGINT NOT NULL,
+            out_of_stock_products BIGINT NOT NULL
+        );
+
+        -- SUM of a BIGINT is NUMERIC, the counts are cast back
+        CREATE OR REPLACE VIEW product_stats_current AS
+        SELECT (s.catalog_version + COALESCE(SUM(d.catalog_version), 0))::BIGINT AS catalog_version,
+               (s.product_count + COALESCE(SUM(d.product_count), 0))::BIGINT AS product_count,
+               (s.price_count + COALESCE(SUM(d.price_count), 0))::BIGINT AS price_count,
+               s.price_sum + COALESCE(SUM(d.price_sum), 0) AS price_sum,
+               (s.stock_count + COALESCE(SUM(d.stock_count), 0))::BIGINT AS stock_count,
+               s.stock_sum + COALESCE(SUM(d.stock_sum), 0) AS stock_sum,
+               s.value_sum + COALESCE(SUM(d.value_sum), 0) AS value_sum,
+               (s.available_products + COALESCE(SUM(d.available_products), 0))::BIGINT AS available_products,
+               (s.out_of_stock_products + COALESCE(SUM(d.out_of_stock_products), 0))::BIGINT AS out_of_stock_products,
+               s.changes_floor
+        FROM product_stats s LEFT JOIN product_stats_deltas d ON TRUE
+        GROUP BY s.id;
+
+        CREATE OR REPLACE FUNCTION product_stats_fold() RETURNS void LANGUAGE plpgsql AS $$
+        BEGIN
+            WITH folded AS (DELETE FROM product_stats_deltas RETURNING *)
+            UPDATE product_stats s SET
+                catalog_version = s.catalog_version + d.catalog_version,
+                product_count = s.product_count + d.product_count,
+                price_count = s.price_count + d.price_count,
+                price_sum = s.price_sum + d.price_sum,
+                stock_count = s.stock_count + d.stock_count,
+                stock_sum = s.stock_sum + d.stock_sum,
+                value_sum = s.value_sum + d.value_sum,
+                available_products = s.available_products + d.available_products,
+                out_of_stock_products = s.out_of_stock_products + d.out_of_stock_products
+            FROM (
+                SELECT COALESCE(SUM(catalog_version), 0) AS catalog_version,
+                       COALESCE(SUM(product_count), 0) AS product_count,
+                       COALESCE(SUM(price_count), 0) AS price_count,
+                       COALESCE(SUM(price_sum), 0) AS price_sum,
+                       COALESCE(SUM(stock_count), 0) AS stock_count,
+                       COALESCE(SUM(stock_sum), 0) AS stock_sum,
+                       COALESCE(SUM(value_sum), 0) AS value_sum,
+                       COALESCE(SUM(available_products), 0) AS available_products,
+                       COALESCE(SUM(out_of_stock_products), 0) AS out_of_stock_products
+                FROM folded
+            ) d;
+        END;
+        $$;
+
+        CREATE OR REPLACE FUNCTION product_stats_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+        DECLARE
+            changed TEXT;
+            delta_id BIGINT;
+        BEGIN
+            IF TG_OP = 'TRUNCATE' THEN
+                PERFORM product_stats_fold();
+                UPDATE product_stats SET catalog_version = catalog_version + 1, product_count = 0,
+                    price_count = 0, price_sum = 0, stock_count = 0, stock_sum = 0, value_sum = 0,
+                    available_products = 0, out_of_stock_products = 0;
+                RETURN NULL;
+            END IF;
+
+            -- old rows count negatively, new rows positively
+            changed := CASE TG_OP
+                WHEN 'INSERT' THEN 'SELECT 1 AS sign, product_price, product_stock FROM new_rows'
+                WHEN 'DELETE' THEN 'SELECT -1 AS sign, product_price, product_stock FROM old_rows'
+                ELSE 'SELECT 1 AS sign, product_price, product_stock FROM new_rows
+                      UNION ALL SELECT -1, product_price, product_stock FROM old_rows'
+            END;
+            -- as in migration 8, a statement that changed no rows adds nothing
+            EXECUTE format($sql$
+                INSERT INTO product_stats_deltas (catalog_version, product_count, price_count, price_sum,
+                    stock_count, stock_sum, value_sum, available_products, out_of_stock_products)
+                SELECT 1, SUM(sign),
+                       COALESCE(SUM(sign) FILTER (WHERE product_price IS NOT NULL), 0),
+                       COALESCE(SUM(sign * product_price::NUMERIC), 0),
+                       COALESCE(SUM(sign) FILTER (WHERE product_stock IS NOT NULL), 0),
+                       COALESCE(SUM(sign * product_stock), 0),
+                       COALESCE(SUM(sign * (product_price * product_stock)::NUMERIC), 0),
+                       COALESCE(SUM(sign) FILTER (WHERE product_stock > 0), 0),
+                       COALESCE(SUM(sign) FILTER (WHERE product_stock <= 0), 0)
+                FROM (%s) r
+                HAVING COUNT(*) > 0
+                RETURNING delta_id
+            $sql$, changed) INTO delta_id;
+
+            -- every 100th statement folds the deltas in, unless another writer is already folding
+            -- (727002: arbitrary advisory lock key). Only folders ever touch the product_stats row
+            IF delta_id % 100 = 0 AND pg_try_advisory_xact_lock(727002) THEN
+                PERFORM product_stats_fold();
+            END IF;
+            RETURN NULL;
+        END;
+        $$;
+
+        -- the catalog version is part of the deltas now
+        DROP TRIGGER IF EXISTS product_catalog_version_insert ON products;
+        DROP TRIGGER IF EXISTS product_catalog_version_update ON products;
+        DROP TRIGGER IF EXISTS product_catalog_version_delete ON products;
+        DROP TRIGGER IF EXISTS product_catalog_version_truncate ON products;
+        DROP FUNCTION IF EXISTS product_catalog_version_bump();
+    """),
+]
+
+# arbitrary key for pg_advisory_xact_lock, so several workers starting together don't migrate twice
+MIGRATION_LOCK_ID = 727001
+
+def run_migrations():
+    """Bring the database schema up to the latest version, returns the versions applied"""
+    applied = []
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INT PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+        """)
+        conn.commit()
+
+        for version, description, sql in MIGRATIONS:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_ID,))
+            cursor.execute("SELECT 1 FROM schema_migrations WHERE version = %s;", (version,))
+            if cursor.fetchone():
+                conn.rollback()
+                continue
+            cursor.execute(sql)
+            cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s);",
+                           (version, description))
+            conn.commit()
+            applied.append(version)
+        cursor.close()
+    return applied
+
+
+#.......FUNCTIONS TO HANDLE DATABASE...............
+# The SQL lives in constants so the psycopg2 functions below and their *_async twins
+# (used when DB_ENGINE=async) always run exactly the same statements.
+
+INSERT_PRODUCT_SQL = """
     INSERT INTO products (product_name, product_description, product_price, product_stock)
     VALUES (%s, %s, %s, %s);
-    """, (product.product_name, product.product_description, product.product_price, product.product_stock))
-    conn.commit()
-    cursor.close()
+"""
 
-def fetch_products_from_db():
-    conn = get_connection(DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT)
-    cursor = conn.cursor()
-    cursor.execute("""
-    SELECT product_id, product_name, product_description, product_price, product_stock FROM products;""")
-    rows = cursor.fetchall()
-    cursor.close()
+SELECT_PRODUCTS_SQL = """
+    SELECT product_id, product_name, product_description, product_price, product_stock, change_seq FROM products;
+"""
+
+# change_seq is the product's version: every update takes a new number from the change sequence.
+# With an expected version only that version is overwritten, without one (NULL) any version is
+UPDATE_PRODUCT_SQL = """
+    UPDATE products
+    SET product_name        = %s,
+        product_description = %s,
+        product_price       = %s,
+        product_stock       = %s
+    WHERE product_id = %s AND change_seq = COALESCE(%s::BIGINT, change_seq)
+    RETURNING change_seq;
+"""
+
+PRODUCT_VERSION_SQL = """
+    SELECT change_seq FROM products WHERE product_id = %s;
+"""
+
+DELETE_PRODUCT_SQL = """
+    DELETE FROM products WHERE product_id = %s;
+"""
+
+# every delta in one statement, the increment happens in the database so concurrent restocks add up
+RESTOCK_SQL = """
+    UPDATE products p
+    SET product_stock = COALESCE(p.product_stock, 0) + v.stock_delta
+    FROM unnest(%s::INT[], %s::INT[]) AS v(product_id, stock_delta)
+    WHERE p.product_id = v.product_id
+    RETURNING p.product_id, p.product_stock;
+"""
+
+PRODUCT_COLUMNS = ['product_id', 'product_name', 'product_description', 'product_price', 'product_stock']
+# what the listings, searches and /changes/ send per product (they all select change_seq)
+PRODUCT_FIELDS = PRODUCT_COLUMNS + ['product_version']
+
+# columns /get_products/ can be sorted by, product_id is always added as the tie breaker
+SORT_FIELDS = ['product_id', 'product_name', 'product_price', 'product_stock']
+MAX_PAGE_SIZE = 1000
+SEARCH_LIMIT = 100
+# searches page with OFFSET ("load more"), which still reads the skipped rows, so it is capped
+MAX_SEARCH_OFFSET = 10000
+
+def encode_cursor(sort, order, row):
+    # the cursor carries the sort key and id of the last row of the page
+    data = {"sort": sort, "order": order, "after": [row[PRODUCT_COLUMNS.index(sort)], row[0]]}
+    return base64.urlsafe_b64encode(json.dumps(data).encode()).decode()
+
+def decode_cursor(token):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token.encode()))
+        sort, order, after = data["sort"], data["order"], data["after"]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Invalid cursor")
+    # after is [last sort value, last product_id], anything else would only fail later in the query
+    if (sort not in SORT_FIELDS or not isinstance(after, list) or len(after) != 2
+            or not cursor_value_valid(sort, after[0]) or not cursor_value_valid("product_id", after[1])):
+        raise ValueError("Invalid cursor")
+    return sort, order, after
+
+def cursor_value_valid(field, value):
+    # a row whose sort column is NULL leaves a null position, product_id is never NULL
+    if value is None:
+        return field != "product_id"
+    if isinstance(value, bool):
+        return False
+    expected = FIELD_TYPES[field]
+    return isinstance(value, (int, float) if expected is float else expected)
+
+def products_page_query(limit, cursor=None, sort="product_id", order="asc"):
+    if sort not in SORT_FIELDS:
+        raise ValueError(f"Invalid sort field: {sort}")
+    if order not in ("asc", "desc"):
+        raise ValueError(f"Invalid sort order: {order}")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+    # the rest of the page can be in two parts, the second following the first in sort order
+    conditions = [""]
+    params = []
+    if cursor:
+        cursor_sort, cursor_order, (last_value, last_id) = decode_cursor(cursor)
+        if (cursor_sort, cursor_order) != (sort, order):
+            raise ValueError("Cursor was created for a different sort order")
+        operator = ">" if order == "asc" else "<"
+        if sort == "product_id":
+            conditions = [f"WHERE product_id {operator} %s"]
+            params = [last_id]
+        elif last_value is None:
+            # NULLs sort last ascending and first descending, among them only product_id orders
+            conditions = [f"WHERE {sort} IS NULL AND product_id {operator} %s"]
+            params = [last_id]
+            if order == "desc":
+                conditions.append(f"WHERE {sort} IS NOT NULL")
+        else:
+            # row comparison keeps the (sort, product_id) index usable
+            conditions = [f"WHERE ({sort}, product_id) {operator} (%s, %s)"]
+            params = [last_value, last_id]
+            if order == "asc":
+                conditions.append(f"WHERE {sort} IS NULL")
+
+    order_by = f"ORDER BY {sort} {order}, product_id {order}"
+    select = """
+        SELECT product_id, product_name, product_description, product_price, product_stock, change_seq
+        FROM products"""
+    # one extra row tells us whether there is a next page
+    if len(conditions) == 1:
+        query = f"{select} {conditions[0]} {order_by} LIMIT %s;"
+        params.append(limit + 1)
+    else:
+        # one index walk per part, an OR of both conditions could not use the index
+        parts = " UNION ALL ".join(f"({select} {condition} {order_by} LIMIT %s)" for condition in conditions)
+        query = f"SELECT * FROM ({parts}) page {order_by} LIMIT %s;"
+        params += [limit + 1] * (len(conditions) + 1)
+    return query, params
+
+def rows_to_page(rows, limit, sort, order):
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(sort, order, rows[-1])
+    return {"items": rows_to_products(rows), "next_cursor": next_cursor}
+
+# /get_stats/ reads the product_stats summary (kept up to date by triggers) instead of scanning products.
+# The highest price/stock lookups walk the (price, id) and (stock, id) indexes backwards.
+STATS_SQL = """
+    SELECT
+        s.product_count,
+        COALESCE(s.price_sum / NULLIF(s.price_count, 0), 0)::DOUBLE PRECISION,
+        COALESCE(s.stock_sum / NULLIF(s.stock_count, 0), 0)::DOUBLE PRECISION,
+        (SELECT product_id FROM products WHERE product_price IS NOT NULL
+         ORDER BY product_price DESC, product_id DESC LIMIT 1),
+        (SELECT MAX(product_price) FROM products),
+        (SELECT product_id FROM products WHERE product_stock IS NOT NULL
+         ORDER BY product_stock DESC, product_id DESC LIMIT 1),
+        (SELECT MAX(product_stock) FROM products),
+        s.value_sum::DOUBLE PRECISION,
+        s.available_products,
+        s.out_of_stock_products
+    FROM product_stats_current s;
+"""
+
+CATALOG_VERSION_SQL = "SELECT catalog_version FROM product_stats_current;"
+
+# The transaction every change before which this snapshot can hand out: older transactions have all
+# finished (a long running write only holds back the changes after it). Past the newest change it
+# stops there, so it only moves when the catalog does. Also the transaction deltas can start after
+CHANGES_WATERMARK_SQL = """
+    SELECT LEAST(pg_snapshot_xmin(pg_current_snapshot())::TEXT::BIGINT,
+                 GREATEST((SELECT MAX(change_xid) FROM products),
+                          (SELECT MAX(change_xid) FROM product_tombstones), 0) + 1),
+           changes_floor
+    FROM product_stats;
+"""
+
+# LIMIT NULL is no limit: without a page size every change is returned at once
+CHANGED_PRODUCTS_SQL = """
+    SELECT product_id, product_name, product_description, product_price, product_stock, change_seq, change_xid
+    FROM products WHERE (change_xid, change_seq) > (%s, %s) AND change_xid < %s
+    ORDER BY change_xid, change_seq LIMIT %s;
+"""
+
+DELETED_PRODUCTS_SQL = """
+    SELECT product_id FROM product_tombstones
+    WHERE (change_xid, change_seq) > (%s, %s) AND (change_xid, change_seq) <= (%s, %s)
+    ORDER BY change_xid, change_seq;
+"""
+
+STATS_SUMMARY_COLUMNS = ['product_count', 'price_count', 'price_sum', 'stock_count', 'stock_sum', 'value_sum',
+                         'available_products', 'out_of_stock_products']
+
+STATS_SUMMARY_SQL = f"SELECT {', '.join(STATS_SUMMARY_COLUMNS)} FROM product_stats_current;"
+
+# what product_stats should contain, computed from scratch
+STATS_SUMMARY_FROM_PRODUCTS_SQL = """
+    SELECT COUNT(*), COUNT(product_price), COALESCE(SUM(product_price::NUMERIC), 0),
+           COUNT(product_stock), COALESCE(SUM(product_stock), 0),
+           COALESCE(SUM((product_price * product_stock)::NUMERIC), 0),
+           COUNT(*) FILTER (WHERE product_stock > 0), COUNT(*) FILTER (WHERE product_stock <= 0)
+    FROM products
+"""
+
+def rows_to_products(rows):
+    with metrics.timer("app_stage_duration_seconds", stage="rows_to_products"):
+        return rows_to_product_dicts(rows)
+
+def rows_to_product_dicts(rows):
+    # the cursor's values are already JSON types (prices are DOUBLE PRECISION), so the dicts are
+    # built in one pass and go to the encoder as they are
+    if rows and len(rows[0]) > 5:
+        # reads that select change_seq also tell the client which version it has, for If-Match on update
+        return [
+            {
+                "product_id": r[0],
+                "product_name": r[1],
+                "product_description": r[2],
+                "product_price": r[3],
+                "product_stock": r[4],
+                "product_version": r[5]
+            }
+            for r in rows
+        ]
     return [
         {
             "product_id": r[0],
@@ -77,181 +1134,1247 @@ def fetch_products_from_db():
         for r in rows
     ]
 
-def update_product_in_db(product_id,product: Product):
-    conn = get_connection(DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT)
-    cursor = conn.cursor()
-    cursor.execute("""
-                   UPDATE products
-                   SET product_name        = %s,
-                       product_description = %s,
-                       product_price       = %s,
-                       product_stock       = %s
-                   WHERE product_id = %s;
-                   """,
-                   (product.product_name, product.product_description, product.product_price, product.product_stock,
-                    product_id))
-    conn.commit()
-    cursor.close()
+def parse_if_match(if_match):
+    """Expected product version from an If-Match header, None when any version may be overwritten"""
+    if if_match is None or if_match.strip() == "*":
+        return None
+    try:
+        return int(if_match.strip().strip('"'))
+    except ValueError:
+        raise ValueError(f'If-Match must be a product version like "42", got {if_match}')
 
-def delete_product_in_db(product_id):
-    conn = get_connection(DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT)
-    cur = conn.cursor()
-
-    cur.execute("""
-        DELETE FROM products WHERE product_id = %s
-    """, (product_id,))
-
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def search_all_fields(search_term):
-    conn = get_connection(DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT)
-    cursor = conn.cursor()
-    search_pattern = f'%{search_term}%'
-    cursor.execute("""
-        SELECT * FROM products WHERE
-            product_id::TEXT ILIKE %s OR
-            product_name ILIKE %s OR
-            product_description ILIKE %s OR
-            product_price::TEXT ILIKE %s OR
-            product_stock::TEXT ILIKE %s;
-    """, (search_pattern, search_pattern, search_pattern, search_pattern, search_pattern))
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return [
-        {
-            "product_id": r[0],
-            "product_name": r[1],
-            "product_description": r[2],
-            "product_price": r[3],
-            "product_stock": r[4]
-        }
-        for r in rows
+def update_result(row, current_row, expected_version):
+    if row:
+        return row[0]
+    # nothing updated: the product is gone, or (with a version) someone else changed it first
+    if current_row and expected_version is not None:
+        raise VersionConflict(current_row[0])
+    return None
+
+def product_params(product: Product):
+    return (product.product_name, product.product_description, product.product_price, product.product_stock)
+
+def escape_like(term):
+    # so % and _ typed by the user are matched literally
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def check_search_window(limit, offset):
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    if not 0 <= offset <= MAX_SEARCH_OFFSET:
+        raise ValueError(f"offset must be between 0 and {MAX_SEARCH_OFFSET}")
+
+def search_all_fields_query(search_term, limit, offset=0):
+    check_search_window(limit, offset)
+
+    params = {"term": search_term, "pattern": f"%{escape_like(search_term)}%", "limit": limit, "offset": offset}
+    # text columns: full text match (GIN on product_search) or substring match (trigram indexes)
+    conditions = [
+        "product_search @@ query",
+        "product_name ILIKE %(pattern)s",
+        "product_description ILIKE %(pattern)s",
     ]
+    rank = ["ts_rank(product_search, query)", "similarity(product_name, %(term)s)"]
+
+    # numeric columns are compared as numbers, so the primary key and btree indexes can be used
+    try:
+        params["int_term"] = int(search_term)
+        conditions += ["product_id = %(int_term)s", "product_stock = %(int_term)s"]
+        rank.append("(product_id = %(int_term)s)::INT")
+    except ValueError:
+        pass
+    try:
+        params["price_term"] = float(search_term)
+        if math.isfinite(params["price_term"]):
+            conditions.append("product_price = %(price_term)s")
+    except ValueError:
+        pass
+
+    query = f"""
+        SELECT product_id, product_name, product_description, product_price, product_stock, change_seq
+        FROM products, websearch_to_tsquery('simple', %(term)s) AS query
+        WHERE {" OR ".join(conditions)}
+        ORDER BY {" + ".join(rank)} DESC, product_id
+        LIMIT %(limit)s OFFSET %(offset)s;
+    """
+    return query, params
+
+# Validate the search_field to prevent SQL injection
+valid_fields = ['product_id', 'product_name', 'product_description', 'product_price', 'product_stock']
 
-def search_product_by_field(search_field, search_term):
-    conn = get_connection(DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT)
-    cursor = conn.cursor()
+# python type every filter value is converted to before it reaches the query
+FIELD_TYPES = {
+    "product_id": int,
+    "product_name": str,
+    "product_description": str,
+    "product_price": float,
+    "product_stock": int,
+}
 
-    # Validate the search_field to prevent SQL injection
-    valid_fields = ['product_id', 'product_name', 'product_description', 'product_price', 'product_stock']
+FILTER_OPERATORS = ["contains", "prefix", "=", "<", "<=", ">", ">=", "between"]
+
+def convert_filter_value(search_field, value):
+    try:
+        return FIELD_TYPES[search_field](value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{search_field} needs a {FIELD_TYPES[search_field].__name__} value, got {value!r}")
+
+def search_by_field_query(search_field, search_term, operator="contains", upper=None, limit=SEARCH_LIMIT, offset=0):
     if search_field not in valid_fields:
         raise ValueError(f"Invalid search field: {search_field}")
+    if operator not in FILTER_OPERATORS:
+        raise ValueError(f"Invalid operator: {operator}")
+    check_search_window(limit, offset)
+    is_text = FIELD_TYPES[search_field] is str
+
+    # Use string formatting for the column name and operator (both whitelisted), parameters for the values
+    order_by = f"{search_field}, product_id"
+    if operator == "contains":
+        # numbers keep the old substring behaviour, text uses the trigram indexes
+        column = search_field if is_text else f"{search_field}::TEXT"
+        condition = f"{column} ILIKE %s"
+        params = [f"%{escape_like(search_term)}%"]
+        order_by = "product_id"
+    elif operator == "prefix":
+        if not is_text:
+            raise ValueError(f"prefix only works on text fields, not {search_field}")
+        condition = f"{search_field} ILIKE %s"
+        params = [f"{escape_like(search_term)}%"]
+    elif operator == "between":
+        if upper is None:
+            raise ValueError("between needs an upper value")
+        condition = f"{search_field} BETWEEN %s AND %s"
+        params = [convert_filter_value(search_field, search_term), convert_filter_value(search_field, upper)]
+    else:
+        # typed comparisons are plain range scans on the (field, product_id) indexes
+        condition = f"{search_field} {operator} %s"
+        params = [convert_filter_value(search_field, search_term)]
 
-    # Use string formatting for the column name, parameter for the value
     query = f"""
-        SELECT * FROM products WHERE {search_field}::TEXT ILIKE %s;
+        SELECT product_id, product_name, product_description, product_price, product_stock, change_seq
+        FROM products WHERE {condition}
+        ORDER BY {order_by}
+        LIMIT %s OFFSET %s;
     """
-    search_term_pattern = f'%{search_term}%'
+    params += [limit, offset]
+    return query, params
 
-    cursor.execute(query, (search_term_pattern,))
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return [
-        {
-            "product_id": r[0],
-            "product_name": r[1],
-            "product_description": r[2],
-            "product_price": r[3],
-            "product_stock": r[4]
-        }
-        for r in rows
-    ]
+def restock_params(items):
+    # a product listed twice would only be updated once by UPDATE ... FROM, so merge the deltas first
+    deltas = {}
+    for item in items:
+        deltas[item.product_id] = deltas.get(item.product_id, 0) + item.stock_delta
+    deltas = {product_id: delta for product_id, delta in deltas.items() if delta != 0}
+    for product_id, delta in deltas.items():
+        if not INT_MIN <= delta <= INT_MAX:
+            raise ValueError(f"Combined stock_delta for product {product_id} is out of range")
+    return list(deltas.keys()), list(deltas.values())
 
-def stats_calculation_in_db():
-    conn = get_connection(DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT product_id, product_name, product_description, product_price, product_stock FROM products;""")
-    rows = cursor.fetchall()
-    cursor.close()
-
-    #... variables that we will need for our stats:....
-    product_count=0
-    price_sum=0
-    stock_sum=0
-    value_sum=0
-    current_highest_price=0
-    highest_price_id=""
-    current_highest_stock=0
-    highest_stock_id=""
-    available_products=0
-    out_of_stock_products=0
-
-    #.... getting info from our database...
-    for row in rows:
-        product_id = row[0]
-        product_price = row[3]
-        product_stock = row[4]
-        product_count=product_count+1
-        price_sum+=float(product_price)
-        stock_sum+=float(product_stock)
-        value_sum+=float(product_price*product_stock)
-        if product_price>current_highest_price:
-            current_highest_price=product_price
-            highest_price_id=product_id
-        if product_stock>current_highest_stock:
-            current_highest_stock=product_stock
-            highest_stock_id=product_id
-        if product_stock>0:
-            available_products=available_products+1
-        else:
-            out_of_stock_products=out_of_stock_products+1
+RESTOCK_OUT_OF_RANGE = "Restock would take a product's stock out of range, nothing was changed"
 
+def rows_to_restock_result(product_ids, rows):
+    updated = {row[0]: row[1] for row in rows}
+    return {
+        "updated": [{"product_id": product_id, "product_stock": stock} for product_id, stock in updated.items()],
+        "missing": [product_id for product_id in product_ids if product_id not in updated],
+    }
 
-    #... Calculating stats....
-    average_price=price_sum/product_count
-    average_stock=stock_sum/product_count
-    stats={
+def row_to_stats(row):
+    (product_count, average_price, average_stock, highest_price_id, highest_price,
+     highest_stock_id, highest_stock, value_sum, available_products, out_of_stock_products) = row
+    # like before, a highest value only counts when it is above zero
+    if not highest_price or highest_price <= 0:
+        highest_price_id, highest_price = "", 0
+    if not highest_stock or highest_stock <= 0:
+        highest_stock_id, highest_stock = "", 0
+    return {
         "product_count": product_count,
         "average_price": average_price,
         "average_stock": average_stock,
         "highest_price_id": highest_price_id,
-        "highest_price": current_highest_price,
+        "highest_price": highest_price,
         "highest_stock_id": highest_stock_id,
-        "highest_stock": current_highest_stock,
+        "highest_stock": highest_stock,
         "value_sum": value_sum,
         "available_products": available_products,
         "out_of_stock_products": out_of_stock_products
     }
-    return stats
 
+def insert_product_to_db(product: Product):
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(INSERT_PRODUCT_SQL, product_params(product))
+        conn.commit()
+        cursor.close()
+
+def fetch_products_from_db():
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(SELECT_PRODUCTS_SQL)
+        rows = cursor.fetchall()
+        cursor.close()
+    return rows_to_products(rows)
+
+def fetch_products_page_from_db(limit, cursor=None, sort="product_id", order="asc"):
+    query, params = products_page_query(limit, cursor, sort, order)
+    with db_pool.connection() as conn:
+        db_cursor = conn.cursor()
+        db_cursor.execute(query, params)
+        rows = db_cursor.fetchall()
+        db_cursor.close()
+    return rows_to_page(rows, limit, sort, order)
+
+def update_product_in_db(product_id,product: Product, expected_version=None):
+    """Returns the new version, None if the product doesn't exist"""
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(UPDATE_PRODUCT_SQL, product_params(product) + (product_id, expected_version))
+        row = cursor.fetchone()
+        current_row = None
+        if row is None:
+            cursor.execute(PRODUCT_VERSION_SQL, (product_id,))
+            current_row = cursor.fetchone()
+        conn.commit()
+        cursor.close()
+    return update_result(row, current_row, expected_version)
+
+def delete_product_in_db(product_id):
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(DELETE_PRODUCT_SQL, (product_id,))
+        conn.commit()
+        cur.close()
+
+def restock_products_in_db(items):
+    product_ids, deltas = restock_params(items)
+    if not product_ids:
+        return rows_to_restock_result([], [])
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(RESTOCK_SQL, (product_ids, deltas))
+        except psycopg2.errors.NumericValueOutOfRange:
+            raise ValueError(RESTOCK_OUT_OF_RANGE)
+        rows = cursor.fetchall()
+        conn.commit()
+        cursor.close()
+    return rows_to_restock_result(product_ids, rows)
+
+def search_all_fields(search_term, limit=SEARCH_LIMIT, offset=0):
+    query, params = search_all_fields_query(search_term, limit, offset)
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        cursor.close()
+    return rows_to_products(rows)
+
+def search_product_by_field(search_field, search_term, operator="contains", upper=None, limit=SEARCH_LIMIT, offset=0):
+    query, params = search_by_field_query(search_field, search_term, operator, upper, limit, offset)
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        cursor.close()
+    return rows_to_products(rows)
+
+def stats_calculation_in_db():
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(STATS_SQL)
+        row = cursor.fetchone()
+        cursor.close()
+    return row_to_stats(row)
+
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+def check_changes_limit(limit):
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+# a position is (transaction, change_seq), sent as "<transaction>.<change_seq>"; 0 is a full load
+CHANGES_START = (0, 0)
+
+def decode_change_position(since):
+    if since == "0":
+        return CHANGES_START
+    xid, _, seq = since.partition(".")
+    if not (xid.isdigit() and seq.isdigit()):
+        raise ValueError("since must be 0 or a version returned by /changes/")
+    return int(xid), int(seq)
+
+def encode_change_position(position):
+    return "%d.%d" % position
+
+def changes_start(since, watermark, floor):
+    # after a TRUNCATE (floor) the deltas are gone, a position past the watermark comes from another
+    # database: either way the client has to start over
+    if (floor and since[0] <= floor) or since > (watermark, 0):
+        return CHANGES_START
+    return since
+
+def changes_page_end(watermark, changed_rows, limit):
+    # a full page stops at its last upsert, the next page continues from there
+    if limit is not None and len(changed_rows) == limit:
+        return changed_rows[-1][6], changed_rows[-1][5]
+    return watermark, 0
+
+def changes_result(since, version, watermark, changed_rows, deleted_rows):
+    # deletes are applied before upserts, so a product deleted and then recreated ends up present
+    return {
+        "since": encode_change_position(since),
+        "version": encode_change_position(version),
+        "reset": since == CHANGES_START,
+        "more": version < (watermark, 0),
+        "deletes": [row[0] for row in deleted_rows],
+        "upserts": rows_to_products(changed_rows),
+    }
+
+def fetch_changes_from_db(since, limit=None):
+    """Products inserted, updated or deleted after position `since`, at most `limit` upserts"""
+    check_changes_limit(limit)
+    since = decode_change_position(since)
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        # one snapshot, so the returned version covers exactly the rows sent with it
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+        cursor.execute(CHANGES_WATERMARK_SQL)
+        watermark, floor = cursor.fetchone()
+        since = changes_start(since, watermark, floor)
+        cursor.execute(CHANGED_PRODUCTS_SQL, since + (watermark, limit))
+        changed_rows = cursor.fetchall()
+        version = changes_page_end(watermark, changed_rows, limit)
+        deleted_rows = []
+        if since != CHANGES_START:
+            cursor.execute(DELETED_PRODUCTS_SQL, since + version)
+            deleted_rows = cursor.fetchall()
+        conn.rollback()
+        cursor.close()
+    return changes_result(since, version, watermark, changed_rows, deleted_rows)
+
+def fetch_changes_watermark():
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(CHANGES_WATERMARK_SQL)
+        watermark = cursor.fetchone()[0]
+        cursor.close()
+    return watermark
+
+def fetch_catalog_version():
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(CATALOG_VERSION_SQL)
+        version = cursor.fetchone()[0]
+        cursor.close()
+    return version
+
+def export_products_from_db(export_format):
+    """Start the export and return a generator of the whole catalog as NDJSON or CSV text, one batch at a time"""
+    # the connection is taken and the query run before the response starts, so a pool timeout or an
+    # SQL error becomes a 503/500 instead of a 200 whose body just stops
+    with ExitStack() as stack:
+        conn = stack.enter_context(db_pool.connection())
+        # a named cursor lives on the server, so only EXPORT_BATCH_SIZE rows are in memory at once
+        cursor = conn.cursor(name="products_export")
+        stack.callback(cursor.close)
+        cursor.execute("""
+            SELECT product_id, product_name, product_description, product_price, product_stock
+            FROM products ORDER BY product_id;
+        """)
+        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        release = stack.pop_all()
+
+    def batches(rows):
+        with release:
+            # primed below: once started, closing the generator (even unread) gives the connection back
+            yield
+            if export_format == "csv":
+                yield ",".join(PRODUCT_COLUMNS) + "\r\n"
+            while rows:
+                if export_format == "csv":
+                    buffer = io.StringIO()
+                    csv.writer(buffer).writerows(rows)
+                    yield buffer.getvalue()
+                else:
+                    yield b"".join(dumps_json(product) + b"\n" for product in rows_to_products(rows))
+                rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+
+    chunks = batches(rows)
+    next(chunks)
+    return chunks
+
+IMPORT_COLUMNS = ['product_name', 'product_description', 'product_price', 'product_stock']
+
+async def iter_import_records(byte_stream, import_format):
+    """Turn the streamed request body into records (one JSON object or one CSV row each)"""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    pending = ""
+    record = ""
+    async for chunk in byte_stream:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            record += line + "\n"
+            # a quoted CSV field can contain newlines, the record ends once its quotes are balanced
+            if import_format == "csv" and record.count('"') % 2:
+                continue
+            if record.strip():
+                yield record
+            record = ""
+    record += pending + decoder.decode(b"", final=True)
+    if record.strip():
+        yield record
+
+def parse_csv_record(record):
+    try:
+        return next(csv.reader([record]))
+    except csv.Error as e:
+        # a bare \r inside an unquoted field, csv.Error is not a ValueError
+        raise ValueError(f"malformed CSV record: {e}")
+
+def parse_import_record(record, import_format, header):
+    if "\x00" in record:
+        # Postgres text columns cannot hold NUL, COPY would refuse the whole chunk
+        raise ValueError("NUL characters are not allowed")
+    if import_format == "csv":
+        values = parse_csv_record(record)
+        if len(values) != len(header):
+            raise ValueError(f"expected {len(header)} columns, got {len(values)}")
+        return dict(zip(header, values))
+    data = json.loads(record)
+    if not isinstance(data, dict):
+        raise ValueError("each line must be a JSON object")
+    if any(isinstance(value, str) and "\x00" in value for value in data.values()):
+        raise ValueError("NUL characters are not allowed")
+    return data
+
+def import_error(result, row_number, error):
+    result["error_count"] += 1
+    if len(result["errors"]) < IMPORT_MAX_ERRORS:
+        result["errors"].append({"row": row_number, "error": error})
+
+def import_chunk_to_db(chunk, import_format, header, result):
+    """Validate a chunk of (row_number, record) pairs and COPY the valid ones, updates result in place"""
+    buffer = io.StringIO()
+    # every field quoted: in CSV COPY an unquoted empty field is NULL, a quoted one is ""
+    writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+    valid_rows = []
+    for row_number, record in chunk:
+        try:
+            product = Product(**parse_import_record(record, import_format, header))
+        except (ValueError, TypeError) as e:
+            # pydantic's ValidationError is a ValueError too
+            import_error(result, row_number, str(e))
+            continue
+        writer.writerow(product_params(product))
+        valid_rows.append((row_number, product_params(product)))
+
+    if not valid_rows:
+        return
+    buffer.seek(0)
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.copy_expert(f"COPY products ({', '.join(IMPORT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+            conn.commit()
+            result["inserted"] += len(valid_rows)
+        except psycopg2.Error:
+            # a row the database refuses (a name too long for its column, a stock out of INT range)
+            # fails the whole COPY: go row by row to find it, the rest of the chunk still goes in
+            conn.rollback()
+            for row_number, params in valid_rows:
+                cursor.execute("SAVEPOINT import_row;")
+                try:
+                    cursor.execute(INSERT_PRODUCT_SQL, params)
+                except (psycopg2.Error, ValueError) as e:
+                    # psycopg2 raises ValueError itself for values it cannot send (a NUL in a string)
+                    cursor.execute("ROLLBACK TO SAVEPOINT import_row;")
+                    import_error(result, row_number, str(e).strip())
+                    continue
+                result["inserted"] += 1
+            conn.commit()
+        cursor.close()
+
+def check_stats_summary():
+    """Compare product_stats with a full recount, returns the columns that differ"""
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        # one snapshot for both reads, otherwise a concurrent write could show up in only one of them
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+        cursor.execute(STATS_SUMMARY_SQL)
+        summary = cursor.fetchone()
+        cursor.execute(STATS_SUMMARY_FROM_PRODUCTS_SQL + ";")
+        recounted = cursor.fetchone()
+        conn.rollback()
+        cursor.close()
+    return {
+        column: {"summary": stored, "recounted": actual}
+        for column, stored, actual in zip(STATS_SUMMARY_COLUMNS, summary, recounted)
+        if stored != actual
+    }
+
+def rebuild_stats_summary():
+    """Recompute product_stats from the products table"""
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        # block writers while recounting so no change is missed or counted twice
+        cursor.execute("LOCK TABLE products IN SHARE MODE;")
+        cursor.execute("SELECT product_stats_fold();")
+        cursor.execute(f"""
+            UPDATE product_stats SET ({', '.join(STATS_SUMMARY_COLUMNS)}) = ({STATS_SUMMARY_FROM_PRODUCTS_SQL});
+        """)
+        conn.commit()
+        cursor.close()
+
+
+#.......ASYNC VERSIONS (DB_ENGINE=async)...............
+
+async def insert_product_to_db_async(product: Product):
+    async with async_db_pool.connection() as conn:
+        await conn.execute(INSERT_PRODUCT_SQL, product_params(product))
+
+async def fetch_products_from_db_async():
+    async with async_db_pool.connection() as conn:
+        cursor = await conn.execute(SELECT_PRODUCTS_SQL)
+        rows = await cursor.fetchall()
+    return rows_to_products(rows)
+
+async def fetch_products_page_from_db_async(limit, cursor=None, sort="product_id", order="asc"):
+    query, params = products_page_query(limit, cursor, sort, order)
+    async with async_db_pool.connection() as conn:
+        db_cursor = await conn.execute(query, params)
+        rows = await db_cursor.fetchall()
+    return rows_to_page(rows, limit, sort, order)
+
+async def update_product_in_db_async(product_id, product: Product, expected_version=None):
+    async with async_db_pool.connection() as conn:
+        cursor = await conn.execute(UPDATE_PRODUCT_SQL, product_params(product) + (product_id, expected_version))
+        row = await cursor.fetchone()
+        current_row = None
+        if row is None:
+            cursor = await conn.execute(PRODUCT_VERSION_SQL, (product_id,))
+            current_row = await cursor.fetchone()
+    return update_result(row, current_row, expected_version)
+
+async def delete_product_in_db_async(product_id):
+    async with async_db_pool.connection() as conn:
+        await conn.execute(DELETE_PRODUCT_SQL, (product_id,))
+
+async def restock_products_in_db_async(items):
+    product_ids, deltas = restock_params(items)
+    if not product_ids:
+        return rows_to_restock_result([], [])
+    async with async_db_pool.connection() as conn:
+        try:
+            cursor = await conn.execute(RESTOCK_SQL, (product_ids, deltas))
+        except psycopg.errors.NumericValueOutOfRange:
+            raise ValueError(RESTOCK_OUT_OF_RANGE)
+        rows = await cursor.fetchall()
+    return rows_to_restock_result(product_ids, rows)
+
+async def search_all_fields_async(search_term, limit=SEARCH_LIMIT, offset=0):
+    query, params = search_all_fields_query(search_term, limit, offset)
+    async with async_db_pool.connection() as conn:
+        cursor = await conn.execute(query, params)
+        rows = await cursor.fetchall()
+    return rows_to_products(rows)
+
+async def search_product_by_field_async(search_field, search_term, operator="contains", upper=None,
+                                        limit=SEARCH_LIMIT, offset=0):
+    query, params = search_by_field_query(search_field, search_term, operator, upper, limit, offset)
+    async with async_db_pool.connection() as conn:
+        cursor = await conn.execute(query, params)
+        rows = await cursor.fetchall()
+    return rows_to_products(rows)
+
+async def stats_calculation_in_db_async():
+    async with async_db_pool.connection() as conn:
+        cursor = await conn.execute(STATS_SQL)
+        row = await cursor.fetchone()
+    return row_to_stats(row)
+
+async def fetch_changes_from_db_async(since, limit=None):
+    check_changes_limit(limit)
+    since = decode_change_position(since)
+    async with async_db_pool.connection() as conn:
+        await conn.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;")
+        cursor = await conn.execute(CHANGES_WATERMARK_SQL)
+        watermark, floor = await cursor.fetchone()
+        since = changes_start(since, watermark, floor)
+        cursor = await conn.execute(CHANGED_PRODUCTS_SQL, since + (watermark, limit))
+        changed_rows = await cursor.fetchall()
+        version = changes_page_end(watermark, changed_rows, limit)
+        deleted_rows = []
+        if since != CHANGES_START:
+            cursor = await conn.execute(DELETED_PRODUCTS_SQL, since + version)
+            deleted_rows = await cursor.fetchall()
+    return changes_result(since, version, watermark, changed_rows, deleted_rows)
+
+async def fetch_changes_watermark_async():
+    async with async_db_pool.connection() as conn:
+        cursor = await conn.execute(CHANGES_WATERMARK_SQL)
+        row = await cursor.fetchone()
+    return row[0]
+
+async def fetch_catalog_version_async():
+    async with async_db_pool.connection() as conn:
+        cursor = await conn.execute(CATALOG_VERSION_SQL)
+        row = await cursor.fetchone()
+    return row[0]
+
+async def run_db(sync_func, async_func, *args):
+    """Run a database function with the engine selected by DB_ENGINE"""
+    if DB_ENGINE == "async":
+        return await async_func(*args)
+    # psycopg2 blocks, so keep it off the event loop
+    return await run_in_threadpool(sync_func, *args)
+
+
+#.......RESPONSE CACHE...............
+
+MISSING = object()
+
+#the CacheBackend is the storage used by ResponseCache, subclass it to keep entries somewhere else (e.g. Redis)
+class CacheBackend:
+    def get(self, key):
+        """Return the stored value, or MISSING"""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def invalidate(self, tag):
+        """Drop every entry whose key starts with tag"""
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class LRUCacheBackend(CacheBackend):
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._bytes = 0                # total size of the cached bodies
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def size(value):
+        return len(value) if isinstance(value, (bytes, bytearray)) else 0
+
+    def _remove(self, key):
+        _, value = self._entries.pop(key)
+        self._bytes -= self.size(value)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        if self.max_entries <= 0 or self.size(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._bytes += self.size(value)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tag):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == tag]:
+                self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+#the ResponseCache keys results by (tag, params) where the tag names the endpoint family
+class ResponseCache:
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self._generations = {}  # tag -> number of invalidations so far
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def get_or_load(self, tag, params, loader):
+        """Return the cached value for (tag, params) or await loader() and cache its result"""
+        key = (tag,) + tuple(params)
+        value = self.backend.get(key)
+        if value is not MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+
+        generation = self._generations.get(tag, 0)
+        value = await loader()
+        # a write that finished while we were loading may have made this value stale, so don't keep it
+        if self._generations.get(tag, 0) == generation:
+            self.backend.set(key, value, self.ttl)
+        return value
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+            self.backend.invalidate(tag)
+        self.invalidations += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "ttl": self.ttl,
+            **self.backend.stats(),
+        }
+
+response_cache = ResponseCache(LRUCacheBackend(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES), CACHE_TTL)
+
+# every product write can change listings, search results and stats
+CATALOG_CACHE_TAGS = ("products", "search", "stats")
+
+def invalidate_catalog_cache():
+    response_cache.invalidate(*CATALOG_CACHE_TAGS)
+
+
+#.......RESPONSE ENCODING...............
+
+# what the read endpoints can answer in, picked from the Accept header
+BODY_FORMATS = {"json": "application/json", "msgpack": "application/msgpack",
+                "arrow": "application/vnd.apache.arrow.stream"}
+ACCEPT_FORMATS = {"application/msgpack": "msgpack", "application/x-msgpack": "msgpack",
+                  "application/vnd.apache.arrow.stream": "arrow",
+                  "application/json": "json", "application/*": "json", "*/*": "json"}
+# arrow is columnar only, so just the product listings offer it
+READ_FORMATS = ("json", "msgpack")
+LISTING_FORMATS = ("json", "msgpack", "arrow")
+
+# rows: a list of product objects; columns: each field name once with an array of its values
+LISTING_LAYOUTS = ("rows", "columns")
+
+def json_default(value):
+    # the few types a query can return that JSON doesn't have, converted like jsonable_encoder did
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps_json(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=json_default)
+    return json.dumps(value, default=json_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+def accept_quality(params):
+    """The q value of one Accept / Accept-Encoding entry, from its parameters"""
+    for param in params:
+        name, _, value = param.partition("=")
+        if name.strip() == "q":
+            try:
+                return float(value)
+            except ValueError:
+                return 0.0
+    return 1.0
+
+def negotiate_format(request: Request, formats=READ_FORMATS):
+    """Pick the format the client prefers among `formats` whose library is installed, json by default"""
+    installed = {"json": True, "msgpack": msgpack is not None, "arrow": pyarrow is not None}
+    quality = {"json": 0.0}
+    for part in request.headers.get("accept", "").split(","):
+        media_type, *params = [item.strip() for item in part.split(";")]
+        body_format = ACCEPT_FORMATS.get(media_type.lower())
+        if body_format not in formats or not installed[body_format]:
+            continue
+        quality[body_format] = max(quality.get(body_format, 0.0), accept_quality(params))
+    # json wins ties, it's what every client can read
+    best = max(quality, key=lambda body_format: (quality[body_format], body_format == "json"))
+    return best if quality[best] > 0 else "json"
+
+def products_to_columns(products):
+    """{"product_id": [...], "product_name": [...], ...} for a list of product dicts"""
+    # an empty result has the same columns as a full one
+    fields = list(products[0]) if products else PRODUCT_FIELDS
+    return {field: [product[field] for product in products] for field in fields}
+
+def listing_to_columns(value):
+    # a page keeps its cursor next to the columns, a /changes/ reply its version and deletes
+    if isinstance(value, dict):
+        key = "upserts" if "upserts" in value else "items"
+        return {**value, key: products_to_columns(value[key])}
+    return products_to_columns(value)
+
+def encode_arrow(value):
+    """One record batch in an Arrow IPC stream, a page's next_cursor goes into the schema metadata"""
+    columns, metadata = value, None
+    if "items" in value:
+        columns = value["items"]
+        metadata = {"next_cursor": value["next_cursor"] or ""}
+    table = pyarrow.table(columns, metadata=metadata)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def encode_body(value, body_format):
+    # the encoded bytes are what the response cache keeps, so this runs once per catalog version
+    with metrics.timer("app_stage_duration_seconds", stage=f"encode_{body_format}"):
+        if body_format == "msgpack":
+            return msgpack.packb(value, default=json_default)
+        if body_format == "arrow":
+            return encode_arrow(value)
+        return dumps_json(value)
+
+
+#.......RESPONSE COMPRESSION...............
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "application/msgpack",
+                      "application/vnd.apache.arrow.stream", "text/")
+
+def negotiate_encoding(accept_encoding):
+    """"br" or "gzip", whichever the client ranks higher (br wins ties), or None to send it as is"""
+    quality = {}
+    for part in accept_encoding.split(","):
+        coding, *params = [item.strip() for item in part.split(";")]
+        if coding:
+            quality[coding.lower()] = accept_quality(params)
+    available = ["gzip"] + (["br"] if brotli is not None else [])
+    best = max(available, key=lambda coding: (quality.get(coding, quality.get("*", 0.0)), coding == "br"))
+    return best if quality.get(best, quality.get("*", 0.0)) > 0 else None
+
+class StreamCompressor:
+    """gzip or brotli over a body sent in chunks, every chunk is flushed so the client can use it right away"""
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "br":
+            self._compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        else:
+            self._compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)  # 31: gzip container
+
+    def compress(self, data, final):
+        if self.encoding == "br":
+            return self._compressor.process(data) + (self._compressor.finish() if final else self._compressor.flush())
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+# bodies and streamed chunks bigger than this are compressed in the threadpool, not on the event loop
+COMPRESSION_THREAD_MIN_SIZE = 256 * 1024
+
+class CompressionMiddleware:
+    """Compress JSON, msgpack, Arrow, NDJSON and CSV responses, streaming ones included, per Accept-Encoding"""
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_SIZE, cache_max_bytes=COMPRESSION_CACHE_MAX_BYTES):
+        self.app = app
+        self.minimum_size = minimum_size
+        # only responses with an ETag (the catalog reads) are kept: for the same path, query and
+        # encoding the ETag names the body exactly. Bounded by the compressed bytes held
+        self.cache_max_bytes = cache_max_bytes
+        self._compressed = OrderedDict()   # (encoding, path, query, etag) -> compressed body
+        self._compressed_bytes = 0
+
+    async def compress_body(self, body, encoding, key=None):
+        if key is not None:
+            compressed = self._compressed.get(key)
+            if compressed is not None:
+                self._compressed.move_to_end(key)
+                return compressed
+        compressed = await self.compress_chunk(StreamCompressor(encoding), body, final=True)
+        if key is not None and len(compressed) <= self.cache_max_bytes:
+            # another request missing on the same key may have stored it while this one was compressing
+            previous = self._compressed.pop(key, None)
+            if previous is not None:
+                self._compressed_bytes -= len(previous)
+            self._compressed[key] = compressed
+            self._compressed_bytes += len(compressed)
+            while self._compressed and self._compressed_bytes > self.cache_max_bytes:
+                _, evicted = self._compressed.popitem(last=False)
+                self._compressed_bytes -= len(evicted)
+        return compressed
+
+    @staticmethod
+    async def compress_chunk(compressor, body, final):
+        # a compressor is only used by one request at a time, so moving it to a thread is safe
+        if len(body) >= COMPRESSION_THREAD_MIN_SIZE:
+            return await run_in_threadpool(compressor.compress, body, final)
+        return compressor.compress(body, final)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+        compressor = None
+
+        async def send_compressed(message):
+            nonlocal start_message, compressor
+            if message["type"] == "http.response.start":
+                # held back until the first body chunk shows whether the response is worth compressing
+                start_message = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+
+            if start_message is not None:
+                headers = MutableHeaders(raw=start_message["headers"])
+                # a streaming response is compressed whatever its first chunk's size, its total size is unknown
+                if self.should_compress(start_message["status"], headers) and (more_body or len(body) >= self.minimum_size):
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if more_body:
+                        compressor = StreamCompressor(encoding)
+                        if "content-length" in headers:
+                            del headers["Content-Length"]
+                        body = await self.compress_chunk(compressor, body, final=False)
+                    else:
+                        etag = headers.get("etag")
+                        key = (encoding, scope["path"], scope["query_string"], etag) if etag else None
+                        body = await self.compress_body(body, encoding, key)
+                        headers["Content-Length"] = str(len(body))
+                    message = {"type": "http.response.body", "body": body, "more_body": more_body}
+                await send(start_message)
+                start_message = None
+            elif compressor is not None:
+                body = await self.compress_chunk(compressor, body, final=not more_body)
+                message = {"type": "http.response.body", "body": body, "more_body": more_body}
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+    @staticmethod
+    def should_compress(status, headers):
+        if status < 200 or status in (204, 304) or "content-encoding" in headers:
+            return False
+        return headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+
+
+#.......CONDITIONAL GET (ETAG)...............
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so W/"5" matches "5"
+    candidates = [value.strip().removeprefix("W/") for value in if_none_match.split(",")]
+    return etag in candidates
+
+async def conditional_get(request: Request, tag, params, loader, layout="rows", formats=READ_FORMATS,
+                          versions=(fetch_catalog_version, fetch_catalog_version_async)):
+    """Answer a catalog read with 304 if the client's ETag is current, otherwise load and encode it (through the cache)"""
+    if layout not in LISTING_LAYOUTS:
+        raise HTTPException(status_code=400, detail=f"Unknown layout: {layout}")
+    # the version is read before the data: if a write slips in between, the client only
+    # gets newer data under an older ETag and downloads it again next time, it never keeps stale data
+    version = await run_db(*versions)
+    body_format = negotiate_format(request, formats)
+    if body_format == "arrow":
+        layout = "columns"
+    # each layout and encoding is its own representation, so it gets its own ETag
+    etag = '"' + "-".join([str(version)] + [part for part in (layout, body_format) if part not in ("rows", "json")]) + '"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    async def load_body():
+        value = await loader()
+        if layout == "columns":
+            value = listing_to_columns(value)
+        return encode_body(value, body_format)
+
+    # the version is part of the cache key, so an entry can't outlive a write made by another worker.
+    # the response is returned as bytes, skipping FastAPI's jsonable_encoder pass over every row
+    body = await response_cache.get_or_load(tag, tuple(params) + (version, layout, body_format), load_body)
+    return Response(content=body, media_type=BODY_FORMATS[body_format], headers=headers)
+
+
+#............APP AND APIS........................
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the psycopg2 pool is always opened: migrations use it in both engine modes
+    open_pool()
+    run_migrations()
+    if DB_ENGINE == "async":
+        await open_async_pool()
+    yield
+    if DB_ENGINE == "async":
+        await close_async_pool()
+    close_pool()
+
+class TimedJSONResponse(JSONResponse):
+    """JSONResponse that records how long serializing the body takes"""
+    def render(self, content):
+        with metrics.timer("app_stage_duration_seconds", stage="json_render"):
+            return super().render(content)
+
+# FastAPI app
+app = FastAPI(lifespan=lifespan, default_response_class=TimedJSONResponse)
+# the ETag stays the same when compressed: it names the catalog version, and If-None-Match compares weakly
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    # for streaming responses this is the time to the first byte, the body is sent afterwards
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # the route template keeps the label count small: /find_products/{search_term}, not every term
+        route = request.scope.get("route")
+        metrics.observe("http_request_duration_seconds", time.perf_counter() - start,
+                        method=request.method, path=getattr(route, "path", "unmatched"), status=str(status))
+
+@app.exception_handler(PoolTimeout)
+def pool_timeout_handler(request: Request, exc: PoolTimeout):
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
 
-#............APIS........................
 @app.post("/create_product/")
-def create_product(product: Product):
-    insert_product_to_db(product)
+async def create_product(product: Product):
+    await run_db(insert_product_to_db, insert_product_to_db_async, product)
+    invalidate_catalog_cache()
     return {"message": "Product created successfully"}
 
 @app.get("/get_products/")
-def get_all_products():
-    products = fetch_products_from_db()
-    return products
+async def get_all_products(request: Request, limit: Optional[int] = None,
+                           cursor: Optional[str] = None, sort: str = "product_id", order: str = "asc",
+                           layout: str = "rows"):
+    # without limit/cursor the whole catalog is returned as a plain list, like before.
+    # layout=columns sends {"product_id": [...], ...} instead, or Accept: application/vnd.apache.arrow.stream
+    if limit is None and cursor is None:
+        products = await conditional_get(
+            request, "products", ("all",),
+            lambda: run_db(fetch_products_from_db, fetch_products_from_db_async),
+            layout, LISTING_FORMATS)
+        return products
+
+    try:
+        page = await conditional_get(
+            request, "products", (limit, cursor, sort, order),
+            lambda: run_db(fetch_products_page_from_db, fetch_products_page_from_db_async,
+                           MAX_PAGE_SIZE if limit is None else limit, cursor, sort, order),
+            layout, LISTING_FORMATS)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return page
 
 @app.put("/update_product/{product_id}")
-def update_product(product_id,product: Product):
-    update_product_in_db(product_id,product)
-    return {"message": "Product updated successfully"}
+async def update_product(product_id: int, product: Product, response: Response,
+                         if_match: Optional[str] = Header(None)):
+    # send If-Match: "<product_version>" to only overwrite the version you read, 409 if it changed since
+    try:
+        expected_version = parse_if_match(if_match)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        version = await run_db(update_product_in_db, update_product_in_db_async, product_id, product, expected_version)
+    except VersionConflict as e:
+        raise HTTPException(status_code=409, detail=str(e), headers={"ETag": f'"{e.current_version}"'})
+    invalidate_catalog_cache()
+    if version is None and expected_version is not None:
+        raise HTTPException(status_code=404, detail=f"Product {product_id} not found")
+    if version is not None:
+        response.headers["ETag"] = f'"{version}"'
+    return {"message": "Product updated successfully", "product_version": version}
 
 @app.delete("/delete_product/{product_id}")
-def delete_product(product_id):
-    delete_product_in_db(product_id)
+async def delete_product(product_id: int):
+    await run_db(delete_product_in_db, delete_product_in_db_async, product_id)
+    invalidate_catalog_cache()
     return {"message":"Product deleted successfully"}
 
+@app.post("/restock_products/")
+async def restock_products(items: List[RestockItem]):
+    # all products are restocked in one transaction, either every delta is applied or none
+    try:
+        result = await run_db(restock_products_in_db, restock_products_in_db_async, items)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    invalidate_catalog_cache()
+    result["message"] = "Products restocked successfully"
+    return result
+
 @app.get("/find_products/{search_term}")
-def search_products(search_term: str):
-    products = search_all_fields(search_term)
+async def search_products(request: Request, search_term: str, limit: int = SEARCH_LIMIT,
+                          offset: int = 0, layout: str = "rows"):
+    # best matches first, at most `limit` of them; offset skips the ones already shown ("load more")
+    try:
+        products = await conditional_get(
+            request, "search", ("all_fields", search_term, limit, offset),
+            lambda: run_db(search_all_fields, search_all_fields_async, search_term, limit, offset),
+            layout, LISTING_FORMATS)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return products
 
 @app.get("/find_product_by_field/{search_field}/{search_term}")
-def serach_products_by_field(search_field,search_term):
-    products = search_product_by_field(search_field,search_term)
+async def serach_products_by_field(request: Request, search_field: str, search_term: str,
+                                   op: str = "contains", upper: Optional[str] = None, limit: int = SEARCH_LIMIT,
+                                   offset: int = 0, layout: str = "rows"):
+    # e.g. /find_product_by_field/product_price/10?op=between&upper=20 or /find_product_by_field/product_stock/5?op=<
+    try:
+        products = await conditional_get(
+            request, "search", ("by_field", search_field, search_term, op, upper, limit, offset),
+            lambda: run_db(search_product_by_field, search_product_by_field_async,
+                           search_field, search_term, op, upper, limit, offset),
+            layout, LISTING_FORMATS)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return products
 
 @app.get("/get_stats/")
-def get_stats():
-    stats = stats_calculation_in_db()
-    return stats
\ No newline at end of file
+async def get_stats(request: Request):
+    stats = await conditional_get(
+        request, "stats", (),
+        lambda: run_db(stats_calculation_in_db, stats_calculation_in_db_async))
+    return stats
+
+@app.get("/changes/")
+async def get_changes(request: Request, since: str = "0", limit: Optional[int] = None, layout: str = "rows"):
+    # e.g. /changes/?since=4711.120: apply "deletes" then "upserts" and remember "version" for the next call.
+    # "reset" means the client has to drop its copy and keep only the upserts (since=0 is a full load).
+    # With limit, "more" says there are changes after "version": ask again with since=version
+    try:
+        # the result follows the watermark rather than the catalog version: a change committed
+        # but still behind an older open transaction is only sent once the watermark passes it
+        changes = await conditional_get(
+            request, "products", ("changes", since, limit),
+            lambda: run_db(fetch_changes_from_db, fetch_changes_from_db_async, since, limit),
+            layout, versions=(fetch_changes_watermark, fetch_changes_watermark_async))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return changes
+
+@app.get("/export_products/")
+def export_products(format: str = "ndjson"):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown export format: {format}")
+    # the query starts here and the generator runs in the threadpool with the psycopg2 pool, whatever DB_ENGINE is
+    headers = {"Content-Disposition": f'attachment; filename="products.{format}"'}
+    return StreamingResponse(export_products_from_db(format), media_type=EXPORT_FORMATS[format], headers=headers)
+
+@app.post("/import_products/")
+async def import_products(request: Request, format: str = "ndjson"):
+    # body: one Product per line (NDJSON) or a CSV file with a header row, streamed rather than loaded at once
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown import format: {format}")
+
+    started = time.perf_counter()
+    result = {"inserted": 0, "error_count": 0, "errors": []}
+    header = None
+    chunk = []
+    row_number = 0
+    try:
+        async for record in iter_import_records(request.stream(), format):
+            if format == "csv" and header is None:
+                try:
+                    header = parse_csv_record(record)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=f"Invalid CSV header: {e}")
+                unknown = set(header) - set(PRODUCT_COLUMNS)
+                if unknown:
+                    raise HTTPException(status_code=400, detail=f"Unknown CSV columns: {', '.join(sorted(unknown))}")
+                continue
+            row_number += 1
+            chunk.append((row_number, record))
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                # each chunk is committed on its own, the COPY always goes through the psycopg2 pool
+                await run_in_threadpool(import_chunk_to_db, chunk, format, header, result)
+                chunk = []
+        if chunk:
+            await run_in_threadpool(import_chunk_to_db, chunk, format, header, result)
+    finally:
+        # chunks committed before a failure are in the table too
+        if result["inserted"]:
+            invalidate_catalog_cache()
+
+    # rows the database refused are found after the chunk's validation errors
+    result["errors"].sort(key=lambda error: error["row"])
+    elapsed = time.perf_counter() - started
+    result["elapsed_s"] = round(elapsed, 3)
+    result["rows_per_sec"] = round(result["inserted"] / elapsed, 1) if elapsed else None
+    return result
+
+@app.get("/cache_stats/")
+def get_cache_stats():
+    return response_cache.stats()
+
+@app.get("/pool_stats/")
+def get_pool_stats():
+    stats = {"engine": DB_ENGINE, "sync_pool": db_pool.stats()}
+    if async_db_pool is not None:
+        stats["async_pool"] = async_db_pool.stats()
+    return stats
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus scrape endpoint: request and query histograms plus the pool and cache stats"""
+    gauges = []
+    pools = [("sync", db_pool)] + ([("async", async_db_pool)] if async_db_pool is not None else [])
+    for name, pool in pools:
+        for key, value in pool.stats().items():
+            if isinstance(value, (int, float)):
+                gauges.append((f"db_pool_{key}", {"pool": name}, value))
+    for key, value in response_cache.stats().items():
+        if isinstance(value, (int, float)):
+            gauges.append((f"response_cache_{key}", {}, value))
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+
+if __name__ == "__main__":
+    # python Back_end.py [migrate|check-stats|rebuild-stats]
+    parser = argparse.ArgumentParser(description="Database maintenance for the products API")
+    parser.add_argument("command", nargs="?", default="migrate", choices=["migrate", "check-stats", "rebuild-stats"])
+    args = parser.parse_args()
+
+    open_pool()
+    try:
+        print("Applied migrations:", run_migrations() or "none, schema is up to date")
+        if args.command == "check-stats":
+            differences = check_stats_summary()
+            if differences:
+                print("product_stats is out of date:", differences)
+                raise SystemExit(1)
+            print("product_stats is consistent")
+        elif args.command == "rebuild-stats":
+            rebuild_stats_summary()
+            print("product_stats rebuilt")
+    finally:
+        close_pool()
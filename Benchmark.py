@@ -0,0 +1,609 @@
+"""Benchmarks for the Back_end API.
+
+    python Benchmark.py load --modes sync async --concurrency 200 --requests 5000
+        Starts the API with uvicorn once per DB_ENGINE mode, drives the same endpoints with
+        many concurrent requests and prints throughput and latency percentiles per mode.
+
+    python Benchmark.py stats --sizes 1000 10000 100000
+        Times /get_stats/ computed in Python from every row (the old way), as a single
+        aggregate query and read from the product_stats summary, on seeded tables of each size.
+
+    python Benchmark.py endpoints --postgres initdb --sizes 1000 100000 1000000 --concurrency 1 50 --output run.jsonl
+        Seeds a fresh database per catalog size (on a throwaway initdb/docker Postgres, or the
+        existing one) and drives every product endpoint, reads first, then the writes. Each run is
+        repeated per --accept-encoding value and reports the bytes that went over the wire.
+
+    python Benchmark.py serialize --rows 10000 100000
+        CPU time per 10k rows to turn product rows into a response body: FastAPI's
+        jsonable_encoder + JSONResponse (the old path) against the encoders the API uses now.
+
+    python Benchmark.py compare before.jsonl after.jsonl
+        Lines up two result files and prints the change in throughput and latency per benchmark.
+
+Needs uvicorn and httpx next to the API requirements, and the database from Back_end.py.
+Every result is printed as one JSON object per line.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+import httpx
+import psycopg2
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+import Back_end
+
+HOST = "127.0.0.1"
+DEFAULT_PATHS = ["/get_stats/", "/find_products/a", "/get_products/"]
+# reads first: the writes change the catalog the later requests would see
+ENDPOINTS = ["get_stats", "get_all_products", "get_all_products_full", "search_products", "serach_products_by_field",
+             "update_product", "create_product", "delete_product"]
+
+
+#.................HELPERS......................
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+def start_server(port, env_overrides):
+    env = dict(os.environ, **env_overrides)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "Back_end:app", "--host", HOST, "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+    )
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"API exited with code {process.returncode}")
+        try:
+            if httpx.get(f"http://{HOST}:{port}/pool_stats/").status_code == 200:
+                return process
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("API did not start in time")
+
+def git_version():
+    # recorded with every result so runs of different versions can be told apart
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def latency_summary(latencies, elapsed):
+    return {
+        "requests": len(latencies),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+#.................LOAD DRIVER......................
+
+async def drive_requests(base_url, requests, concurrency, headers=None):
+    """Send the (method, url, json_body) requests in order keeping `concurrency` of them in flight"""
+    latencies = []
+    errors = 0
+    downloaded = 0
+    next_request = 0
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60, headers=headers) as client:
+        async def worker():
+            nonlocal next_request, errors, downloaded
+            while next_request < len(requests):
+                method, url, body = requests[next_request]
+                next_request += 1
+                start = time.perf_counter()
+                try:
+                    response = await client.request(method, url, json=body)
+                    # the body as it came over the wire, before httpx decompresses it
+                    downloaded += response.num_bytes_downloaded
+                    if response.status_code >= 400:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    return {"concurrency": concurrency, "errors": errors, **latency_summary(latencies, elapsed),
+            "bytes_per_request": round(downloaded / len(latencies)) if latencies else 0}
+
+async def drive(base_url, path, total_requests, concurrency):
+    """Send total_requests GETs to path keeping `concurrency` of them in flight"""
+    result = await drive_requests(base_url, [("GET", path, None)] * total_requests, concurrency)
+    return {"path": path, **result}
+
+def run_mode(mode, args):
+    process = start_server(args.port, {"DB_ENGINE": mode, "DB_POOL_MAX": str(args.pool_size)})
+    try:
+        base_url = f"http://{HOST}:{args.port}"
+        results = []
+        for path in args.paths:
+            # short warm-up so connection setup isn't part of the numbers
+            asyncio.run(drive(base_url, path, min(50, args.requests), min(10, args.concurrency)))
+            result = asyncio.run(drive(base_url, path, args.requests, args.concurrency))
+            result["mode"] = mode
+            results.append(result)
+        return results
+    finally:
+        stop_server(process)
+
+
+#.................STATS BENCHMARK......................
+
+BENCH_SCHEMA = "benchmark"
+
+# /get_stats/ as a single aggregate over the whole table, before product_stats existed
+FULL_SCAN_STATS_SQL = """
+    SELECT
+        COUNT(*),
+        COALESCE(AVG(product_price), 0)::DOUBLE PRECISION,
+        COALESCE(AVG(product_stock), 0)::DOUBLE PRECISION,
+        (SELECT product_id FROM products WHERE product_price IS NOT NULL
+         ORDER BY product_price DESC, product_id DESC LIMIT 1),
+        MAX(product_price),
+        (SELECT product_id FROM products WHERE product_stock IS NOT NULL
+         ORDER BY product_stock DESC, product_id DESC LIMIT 1),
+        MAX(product_stock),
+        COALESCE(SUM(product_price * product_stock), 0)::DOUBLE PRECISION,
+        COUNT(*) FILTER (WHERE product_stock > 0),
+        COUNT(*) FILTER (WHERE product_stock <= 0)
+    FROM products;
+"""
+
+def legacy_stats(rows):
+    # /get_stats/ before it moved into SQL: every row is sent to Python and looped over
+    product_count = price_sum = stock_sum = value_sum = 0
+    highest_price = highest_stock = 0
+    highest_price_id = highest_stock_id = ""
+    available_products = out_of_stock_products = 0
+    for product_id, _, _, product_price, product_stock, *_ in rows:
+        product_count += 1
+        price_sum += float(product_price)
+        stock_sum += float(product_stock)
+        value_sum += float(product_price * product_stock)
+        if product_price > highest_price:
+            highest_price, highest_price_id = product_price, product_id
+        if product_stock > highest_stock:
+            highest_stock, highest_stock_id = product_stock, product_id
+        if product_stock > 0:
+            available_products += 1
+        else:
+            out_of_stock_products += 1
+    return {
+        "product_count": product_count,
+        "average_price": price_sum / product_count,
+        "average_stock": stock_sum / product_count,
+        "highest_price_id": highest_price_id,
+        "highest_price": highest_price,
+        "highest_stock_id": highest_stock_id,
+        "highest_stock": highest_stock,
+        "value_sum": value_sum,
+        "available_products": available_products,
+        "out_of_stock_products": out_of_stock_products,
+    }
+
+def connect_benchmark_db():
+    conn = psycopg2.connect(database=Back_end.DB_NAME, user=Back_end.DB_USER, password=Back_end.DB_PASSWORD,
+                            host=Back_end.DB_HOST, port=Back_end.DB_PORT)
+    cursor = conn.cursor()
+    # a separate schema first on the search_path: the API's SQL runs unchanged against seeded data
+    cursor.execute(f"SET search_path TO {BENCH_SCHEMA}, public;")
+    conn.commit()
+    return conn
+
+def seed_products(conn, size):
+    cursor = conn.cursor()
+    cursor.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE;")
+    cursor.execute(f"CREATE SCHEMA {BENCH_SCHEMA};")
+    # the full schema, so indexes and triggers match production
+    for _, _, sql in Back_end.MIGRATIONS:
+        cursor.execute(sql)
+    cursor.execute("""
+        INSERT INTO products (product_name, product_description, product_price, product_stock)
+        SELECT 'product ' || i, 'description of product ' || i, round((random() * 1000)::numeric, 2),
+               (random() * 200)::INT - 20
+        FROM generate_series(1, %s) AS i;
+    """, (size,))
+    cursor.execute("ANALYZE products;")
+    conn.commit()
+
+def time_call(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def run_stats_benchmark(args):
+    conn = connect_benchmark_db()
+    cursor = conn.cursor()
+
+    def old_path():
+        cursor.execute(Back_end.SELECT_PRODUCTS_SQL)
+        return legacy_stats(cursor.fetchall())
+
+    def aggregate_path():
+        cursor.execute(FULL_SCAN_STATS_SQL)
+        return Back_end.row_to_stats(cursor.fetchone())
+
+    def summary_path():
+        cursor.execute(Back_end.STATS_SQL)
+        return Back_end.row_to_stats(cursor.fetchone())
+
+    try:
+        for size in args.sizes:
+            seed_products(conn, size)
+            for name, func in (("python_loop", old_path), ("sql_aggregate", aggregate_path),
+                               ("summary_table", summary_path)):
+                func()  # warm-up
+                timings = time_call(func, args.repeat)
+                print(json.dumps({
+                    "benchmark": "stats",
+                    "path": name,
+                    "rows": size,
+                    "repeat": args.repeat,
+                    "p50_ms": round(percentile(timings, 50) * 1000, 2),
+                    "p95_ms": round(percentile(timings, 95) * 1000, 2),
+                }))
+            conn.rollback()
+    finally:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE;")
+        conn.commit()
+        conn.close()
+
+
+#.................LOCAL POSTGRES......................
+
+BENCH_DATABASE = "products_benchmark"
+
+def connect(settings, database):
+    return psycopg2.connect(dbname=database, user=settings["DB_USER"], password=settings["DB_PASSWORD"],
+                            host=settings["DB_HOST"], port=settings["DB_PORT"])
+
+def wait_for_postgres(settings, timeout=60):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            connect(settings, "postgres").close()
+            return
+        except psycopg2.OperationalError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.5)
+
+@contextmanager
+def local_postgres(args):
+    """Yield the DB_* settings of the Postgres to benchmark against, starting a throwaway one if asked"""
+    if args.postgres == "existing":
+        yield {"DB_HOST": Back_end.DB_HOST, "DB_PORT": str(Back_end.DB_PORT),
+               "DB_USER": Back_end.DB_USER, "DB_PASSWORD": Back_end.DB_PASSWORD}
+        return
+
+    settings = {"DB_HOST": "127.0.0.1", "DB_PORT": str(args.pg_port), "DB_USER": "postgres"}
+    if args.postgres == "initdb":
+        # a fresh cluster in a temp dir, removed afterwards (initdb refuses to run as root)
+        data_dir = tempfile.mkdtemp(prefix="products_benchmark_")
+        initdb = os.path.join(args.pg_bin, "initdb") if args.pg_bin else "initdb"
+        pg_ctl = os.path.join(args.pg_bin, "pg_ctl") if args.pg_bin else "pg_ctl"
+        subprocess.run([initdb, "-D", data_dir, "-U", "postgres", "--auth=trust", "-E", "UTF8"],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([pg_ctl, "-D", data_dir, "-l", os.path.join(data_dir, "server.log"), "-w",
+                        "-o", f"-p {args.pg_port} -k {data_dir} -c listen_addresses=127.0.0.1", "start"],
+                       check=True, stdout=subprocess.DEVNULL)
+        try:
+            settings["DB_PASSWORD"] = ""
+            wait_for_postgres(settings)
+            yield settings
+        finally:
+            subprocess.run([pg_ctl, "-D", data_dir, "-m", "fast", "-w", "stop"], stdout=subprocess.DEVNULL)
+            shutil.rmtree(data_dir, ignore_errors=True)
+    else:
+        container = f"products-benchmark-{os.getpid()}"
+        subprocess.run(["docker", "run", "-d", "--rm", "--name", container, "-e", "POSTGRES_PASSWORD=benchmark",
+                        "-p", f"127.0.0.1:{args.pg_port}:5432", args.docker_image],
+                       check=True, stdout=subprocess.DEVNULL)
+        try:
+            settings["DB_PASSWORD"] = "benchmark"
+            wait_for_postgres(settings)
+            yield settings
+        finally:
+            subprocess.run(["docker", "stop", container], stdout=subprocess.DEVNULL)
+
+def create_benchmark_database(settings):
+    conn = connect(settings, "postgres")
+    conn.autocommit = True  # CREATE/DROP DATABASE can't run in a transaction
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"DROP DATABASE IF EXISTS {BENCH_DATABASE};")
+        cursor.execute(f"CREATE DATABASE {BENCH_DATABASE};")
+    finally:
+        conn.close()
+
+SEED_WORDS = ["red", "green", "blue", "steel", "wooden", "small", "large", "classic", "pro", "mini"]
+
+def seed_catalog(settings, size):
+    """Fill the (migrated, empty) benchmark database with `size` products, through the real triggers"""
+    conn = connect(settings, BENCH_DATABASE)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO products (product_name, product_description, product_price, product_stock)
+            SELECT 'product ' || i,
+                   (%(words)s)[1 + i %% 10] || ' ' || (%(words)s)[1 + (i / 10) %% 10] || ' item number ' || i,
+                   round((random() * 1000)::numeric, 2),
+                   (random() * 200)::INT - 20
+            FROM generate_series(1, %(size)s) AS i;
+        """, {"words": SEED_WORDS, "size": size})
+        conn.commit()
+        conn.autocommit = True
+        cursor.execute("VACUUM ANALYZE products;")
+    finally:
+        conn.close()
+
+
+#.................ENDPOINT SUITE......................
+
+def random_product(rng):
+    return {
+        "product_name": f"benchmark product {rng.randrange(10 ** 9)}",
+        "product_description": f"{rng.choice(SEED_WORDS)} {rng.choice(SEED_WORDS)} benchmark item",
+        "product_price": round(rng.uniform(1, 1000), 2),
+        "product_stock": rng.randrange(0, 200),
+    }
+
+def search_term(rng, size):
+    return rng.choice([rng.choice(SEED_WORDS), f"product {rng.randrange(1, size + 1)}"])
+
+def endpoint_scenarios(size, args, delete_ids):
+    """name -> function(rng, count) building that many requests, delete_ids hands out each seeded id once"""
+    scenarios = {
+        "get_stats": lambda rng, n: [("GET", "/get_stats/", None)] * n,
+        "get_all_products": lambda rng, n: [
+            ("GET", f"/get_products/?limit={args.page_size}&sort={rng.choice(['product_id', 'product_price'])}", None)
+            for _ in range(n)],
+        "search_products": lambda rng, n: [
+            ("GET", f"/find_products/{search_term(rng, size)}?limit=20", None) for _ in range(n)],
+        "serach_products_by_field": lambda rng, n: [
+            rng.choice([
+                ("GET", f"/find_product_by_field/product_name/{search_term(rng, size)}?limit=20", None),
+                ("GET", f"/find_product_by_field/product_price/{rng.randrange(900)}?op=between"
+                        f"&upper={rng.randrange(900, 1000)}&limit=20", None),
+            ]) for _ in range(n)],
+        "update_product": lambda rng, n: [
+            ("PUT", f"/update_product/{rng.randrange(1, size + 1)}", random_product(rng)) for _ in range(n)],
+        "create_product": lambda rng, n: [("POST", "/create_product/", random_product(rng)) for _ in range(n)],
+        "delete_product": lambda rng, n: [
+            ("DELETE", f"/delete_product/{product_id}", None) for product_id in
+            [next(delete_ids, None) for _ in range(n)] if product_id is not None],
+    }
+    # the unpaged listing sends the whole catalog per request, only worth it for small catalogs
+    if size <= args.full_list_max:
+        scenarios["get_all_products_full"] = lambda rng, n: [("GET", "/get_products/", None)] * n
+    return {name: scenarios[name] for name in args.endpoints if name in scenarios}
+
+def run_endpoint_benchmark(args):
+    version = git_version()
+    output = open(args.output, "a") if args.output else None
+    try:
+        with local_postgres(args) as settings:
+            for size in args.sizes:
+                create_benchmark_database(settings)
+                env = dict(settings, DB_NAME=BENCH_DATABASE, DB_ENGINE=args.engine, DB_POOL_MAX=str(args.pool_size))
+                if args.no_cache:
+                    env["CACHE_MAX_ENTRIES"] = "0"
+                # the API runs the migrations on startup, then the empty tables are seeded
+                process = start_server(args.port, env)
+                try:
+                    started = time.perf_counter()
+                    seed_catalog(settings, size)
+                    seeded_s = round(time.perf_counter() - started, 3)
+                    base_url = f"http://{HOST}:{args.port}"
+                    asyncio.run(drive(base_url, "/get_stats/", 20, 5))  # open the pool's connections
+
+                    # deletes take ids from the top of the seeded range, once each, across all concurrency levels
+                    delete_ids = iter(range(size, 0, -1))
+                    for concurrency in args.concurrency:
+                        for accept_encoding in args.accept_encoding:
+                            # the same seed gives the same requests, so two versions (or encodings) see identical load
+                            rng = random.Random(f"{args.seed}-{size}-{concurrency}")
+                            headers = {"Accept-Encoding": accept_encoding}
+                            for name, build in endpoint_scenarios(size, args, delete_ids).items():
+                                requests = build(rng, args.requests)
+                                if not requests:
+                                    continue
+                                result = {
+                                    "benchmark": "endpoints",
+                                    "endpoint": name,
+                                    "rows": size,
+                                    "engine": args.engine,
+                                    "cache": not args.no_cache,
+                                    "accept_encoding": accept_encoding,
+                                    **asyncio.run(drive_requests(base_url, requests, concurrency, headers)),
+                                    "seed_s": seeded_s,
+                                    "version": version,
+                                }
+                                line = json.dumps(result)
+                                print(line, flush=True)
+                                if output:
+                                    output.write(line + "\n")
+                                    output.flush()
+                finally:
+                    stop_server(process)
+    finally:
+        if output:
+            output.close()
+
+
+#.................SERIALIZATION BENCHMARK......................
+
+def synthetic_rows(count):
+    # shaped like the product SELECTs return them: id, name, description, price, stock, change_seq
+    return [(i, f"product {i}", f"{SEED_WORDS[i % 10]} item number {i}", round(i * 0.37 % 1000, 2), i % 200 - 20, i)
+            for i in range(1, count + 1)]
+
+def serializers():
+    products = Back_end.rows_to_products
+    paths = {
+        # what every read endpoint did before: dicts, jsonable_encoder over every value, then JSONResponse
+        "jsonable_encoder": lambda rows: JSONResponse(jsonable_encoder(products(rows))).body,
+        "stdlib_json": lambda rows: json.dumps(products(rows), default=Back_end.json_default,
+                                               ensure_ascii=False, separators=(",", ":")).encode(),
+    }
+    if Back_end.orjson is not None:
+        paths["orjson"] = lambda rows: Back_end.encode_body(products(rows), "json")
+    if Back_end.msgpack is not None:
+        paths["msgpack"] = lambda rows: Back_end.encode_body(products(rows), "msgpack")
+    # layout=columns: the field names once instead of once per product
+    paths["columns_json"] = lambda rows: Back_end.encode_body(Back_end.listing_to_columns(products(rows)), "json")
+    if Back_end.pyarrow is not None:
+        paths["columns_arrow"] = lambda rows: Back_end.encode_body(Back_end.listing_to_columns(products(rows)), "arrow")
+    return paths
+
+def run_serialize_benchmark(args):
+    for count in args.rows:
+        rows = synthetic_rows(count)
+        for name, serialize in serializers().items():
+            body = serialize(rows)  # warm-up
+            # CPU time rather than wall time: this is the work a worker can't spend on other requests
+            started = time.process_time()
+            for _ in range(args.repeat):
+                serialize(rows)
+            cpu = (time.process_time() - started) / args.repeat
+            print(json.dumps({
+                "benchmark": "serialize",
+                "format": name,
+                "rows": count,
+                "repeat": args.repeat,
+                "cpu_ms": round(cpu * 1000, 2),
+                "cpu_ms_per_10k_rows": round(cpu * 1000 * 10000 / count, 2),
+                "body_bytes": len(body),
+            }))
+
+
+#.................COMPARE......................
+
+# the fields that identify a measurement, the rest are results
+RESULT_KEY_FIELDS = ("benchmark", "endpoint", "path", "mode", "engine", "cache", "accept_encoding", "rows",
+                     "concurrency", "format")
+COMPARED_FIELDS = ("throughput_rps", "p50_ms", "p95_ms", "p99_ms", "bytes_per_request", "cpu_ms_per_10k_rows")
+
+def load_results(path):
+    results = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                # the last run wins when a file holds the same measurement twice
+                results[tuple((field, result[field]) for field in RESULT_KEY_FIELDS if field in result)] = result
+    return results
+
+def run_compare(args):
+    before = load_results(args.before)
+    after = load_results(args.after)
+    for key in sorted(before.keys() & after.keys(), key=str):
+        comparison = dict(key)
+        for field in COMPARED_FIELDS:
+            old, new = before[key].get(field), after[key].get(field)
+            if old is None or new is None:
+                continue
+            comparison[field] = [old, new]
+            comparison[f"{field}_change_pct"] = round((new - old) / old * 100, 1) if old else None
+        print(json.dumps(comparison))
+
+
+#.................MAIN......................
+
+def run_load_benchmark(args):
+    # one JSON object per line so runs can be diffed or loaded into a spreadsheet
+    for mode in args.modes:
+        for result in run_mode(mode, args):
+            print(json.dumps(result))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the Back_end API")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    load = subparsers.add_parser("load", help="compare sync and async database engines under load")
+    load.add_argument("--modes", nargs="+", default=["sync", "async"], choices=["sync", "async"])
+    load.add_argument("--paths", nargs="+", default=DEFAULT_PATHS)
+    load.add_argument("--requests", type=int, default=2000)
+    load.add_argument("--concurrency", type=int, default=200)
+    load.add_argument("--pool-size", type=int, default=10)
+    load.add_argument("--port", type=int, default=8765)
+    load.set_defaults(func=run_load_benchmark)
+
+    stats = subparsers.add_parser("stats", help="python loop vs SQL aggregate vs summary table for /get_stats/")
+    stats.add_argument("--sizes", nargs="+", type=int, default=[1000, 10000, 100000])
+    stats.add_argument("--repeat", type=int, default=20)
+    stats.set_defaults(func=run_stats_benchmark)
+
+    endpoints = subparsers.add_parser("endpoints", help="every product endpoint on seeded catalogs of several sizes")
+    endpoints.add_argument("--postgres", default="existing", choices=["existing", "initdb", "docker"],
+                           help="existing: the server from Back_end's DB_* settings, initdb/docker: a throwaway one")
+    endpoints.add_argument("--pg-bin", help="directory with initdb and pg_ctl, if they are not on PATH")
+    endpoints.add_argument("--pg-port", type=int, default=54329)
+    endpoints.add_argument("--docker-image", default="postgres:16")
+    endpoints.add_argument("--sizes", nargs="+", type=int, default=[1000, 100000, 1000000])
+    endpoints.add_argument("--endpoints", nargs="+", default=ENDPOINTS, choices=ENDPOINTS)
+    endpoints.add_argument("--concurrency", nargs="+", type=int, default=[1, 50])
+    endpoints.add_argument("--requests", type=int, default=500, help="requests per endpoint and concurrency level")
+    endpoints.add_argument("--accept-encoding", nargs="+", default=["identity", "gzip, br"],
+                           help="run every endpoint once per Accept-Encoding value, to compare bytes on the wire")
+    endpoints.add_argument("--engine", default="sync", choices=["sync", "async"])
+    endpoints.add_argument("--pool-size", type=int, default=10)
+    endpoints.add_argument("--page-size", type=int, default=100)
+    endpoints.add_argument("--full-list-max", type=int, default=10000,
+                           help="also time the unpaged /get_products/ for catalogs up to this size")
+    endpoints.add_argument("--no-cache", action="store_true", help="run the API with the response cache off")
+    endpoints.add_argument("--seed", type=int, default=1)
+    endpoints.add_argument("--port", type=int, default=8765)
+    endpoints.add_argument("--output", help="also append the results to this JSON lines file")
+    endpoints.set_defaults(func=run_endpoint_benchmark)
+
+    serialize = subparsers.add_parser("serialize", help="CPU per 10k rows of each way to encode a listing")
+    serialize.add_argument("--rows", nargs="+", type=int, default=[10000, 100000])
+    serialize.add_argument("--repeat", type=int, default=10)
+    serialize.set_defaults(func=run_serialize_benchmark)
+
+    compare = subparsers.add_parser("compare", help="change between two result files")
+    compare.add_argument("before")
+    compare.add_argument("after")
+    compare.set_defaults(func=run_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,184 @@
+import queue
+import sys
+import threading
+import time
 import tkinter as tk
+from concurrent.futures import ThreadPoolExecutor
 from tkinter import ttk, messagebox
+from urllib.parse import quote
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 API_URL = "http://127.0.0.1:8000"
+# seconds to connect and to wait for a response, so a dead backend can't hang a call forever
+API_CONNECT_TIMEOUT = 3
+API_READ_TIMEOUT = 30
+# idempotent calls (GET, PUT, DELETE) are retried on connection errors and 502/503/504,
+# waiting API_RETRY_BACKOFF * 2**n seconds in between
+API_RETRIES = 3
+API_RETRY_BACKOFF = 0.5
+# the product store is loaded PAGE_SIZE products per request, so no single response gets too big
+PAGE_SIZE = 500
+# search results are fetched SEARCH_PAGE_SIZE at a time ("Load more" gets the next ones), and
+# search-as-you-type waits SEARCH_DEBOUNCE_MS after the last key before asking the server
+SEARCH_PAGE_SIZE = 50
+SEARCH_DEBOUNCE_MS = 300
+SEARCH_MIN_CHARS = 2
+# how long the local product store is trusted before asking the server for changes again
+STORE_MAX_AGE = 5
+# API calls run on these threads so the window never freezes while waiting for the server
+WORKER_THREADS = 4
+WORKER_POLL_MS = 50
+
+# last stats read and its ETag, sent back as If-None-Match so unchanged stats aren't downloaded again
+last_stats = {"etag": None, "stats": None}
 
 
 #.................CLASSES AND HELPER SCRIPTS......................
 
+#the VirtualTreeview keeps every row in a plain list but only creates Treeview items for the rows on
+#screen. Scrolling reuses those items with other values, so tens of thousands of products cost no more
+#to show than a screenful, and set_rows only touches the items whose row actually changed
+class VirtualTreeview(ttk.Treeview):
+    def __init__(self, master=None, **kwargs):
+        super().__init__(master, **kwargs)
+        self.rows = []              # (key, values, tags) for every row, in display order
+        self.positions = {}         # key -> index in rows
+        self.first = 0              # index of the row shown in the top item
+        self.visible = int(kwargs.get("height", 10))
+        self.slots = []             # the Treeview items, reused for whatever rows are on screen
+        self.shown = {}             # item -> the row it currently shows
+        self.selected_key = None
+        self.scrollbar = None
+        self.on_scroll_end = None   # called when the last row comes into view, e.g. to load the next page
+
+        self.bind("<Configure>", self._on_configure)
+        self.bind("<<TreeviewSelect>>", self._on_select, add="+")
+        self.bind("<MouseWheel>", self._on_mouse_wheel)
+        self.bind("<Button-4>", lambda e: self.yview("scroll", -3, "units"))
+        self.bind("<Button-5>", lambda e: self.yview("scroll", 3, "units"))
+        self.bind("<Up>", lambda e: self._move_selection(-1))
+        self.bind("<Down>", lambda e: self._move_selection(1))
+        self.bind("<Prior>", lambda e: self._move_selection(-self.visible))
+        self.bind("<Next>", lambda e: self._move_selection(self.visible))
+
+    def attach_scrollbar(self, scrollbar):
+        # the scrollbar follows our row window, not the few items the Treeview actually holds
+        self.scrollbar = scrollbar
+        scrollbar.configure(command=self.yview)
+
+    def set_rows(self, rows, keep_position=True):
+        """Show these (key, values, tags) rows, by default keeping the scroll position"""
+        self.rows = list(rows)
+        self.positions = {row[0]: index for index, row in enumerate(self.rows)}
+        if not keep_position:
+            self.first = 0
+        self._render()
+
+    def append_rows(self, rows):
+        for row in rows:
+            self.positions[row[0]] = len(self.rows)
+            self.rows.append(row)
+        self._render()
+
+    def set_item_values(self, item, values):
+        key, _, tags = self.shown[item]
+        self.rows[self.positions[key]] = (key, tuple(values), tags)
+        self._render()
+
+    def row_key(self, item):
+        return self.shown[item][0] if item in self.shown else None
+
+    def yview(self, *args):
+        if not args:
+            total = max(len(self.rows), 1)
+            return self.first / total, min(self.first + self.visible, total) / total
+        if args[0] == "moveto":
+            self.first = int(float(args[1]) * len(self.rows))
+        elif args[0] == "scroll":
+            step = int(args[1]) * (self.visible if args[2] == "pages" else 1)
+            self.first += step
+        self._render()
+
+    def _on_mouse_wheel(self, event):
+        # Windows reports multiples of 120 per notch, macOS single steps
+        notches = event.delta // 120 if abs(event.delta) >= 120 else event.delta
+        self.yview("scroll", -3 * notches, "units")
+        return "break"
+
+    def _move_selection(self, step):
+        if not self.rows:
+            return "break"
+        index = self.positions.get(self.selected_key, -1 if step > 0 else len(self.rows))
+        index = max(0, min(len(self.rows) - 1, index + step))
+        self.selected_key = self.rows[index][0]
+        # scroll just enough to keep the selected row on screen
+        if index < self.first:
+            self.first = index
+        elif index >= self.first + self.visible:
+            self.first = index - self.visible + 1
+        self._render()
+        return "break"
+
+    def _on_select(self, event):
+        # an empty selection only means the selected row was scrolled away
+        selection = self.selection()
+        if selection and selection[0] in self.shown:
+            self.selected_key = self.shown[selection[0]][0]
+
+    def _on_configure(self, event):
+        # as many items as fit in the widget, measured from an item already on screen when possible
+        bbox = self.bbox(self.slots[0]) if self.slots else None
+        header, row_height = (bbox[1], bbox[3]) if bbox else (25, 20)
+        visible = max(1, (event.height - header) // row_height)
+        if visible != self.visible:
+            self.visible = visible
+            self._render()
+
+    def _render(self):
+        self.first = max(0, min(self.first, len(self.rows) - self.visible))
+        rows = self.rows[self.first:self.first + self.visible]
+
+        while len(self.slots) < len(rows):
+            self.slots.append(super().insert("", "end"))
+        while len(self.slots) > len(rows):
+            item = self.slots.pop()
+            self.shown.pop(item, None)
+            self.delete(item)
+
+        selected = ()
+        for item, row in zip(self.slots, rows):
+            # only items showing a different row than before are updated
+            if self.shown.get(item) != row:
+                self.item(item, values=row[1], tags=row[2])
+                self.shown[item] = row
+            if row[0] == self.selected_key:
+                selected = (item,)
+        if tuple(self.selection()) != selected:
+            self.selection_set(selected)
+            if selected:
+                self.focus(selected[0])
+
+        if self.scrollbar:
+            self.scrollbar.set(*self.yview())
+        if self.on_scroll_end and rows and self.first + len(rows) >= len(self.rows):
+            self.on_scroll_end()
+
 #the EditableTreeview is used in the restocking tab. It allows double clicking on field to edit
-class EditableTreeview(ttk.Treeview):
+class EditableTreeview(VirtualTreeview):
     def __init__(self, master=None, **kwargs):
         super().__init__(master, **kwargs)
         self.bind("<Double-1>", self._on_double_click)
         self._edit_box = None
 
+    def yview(self, *args):
+        # the edited item is about to show another row
+        if args:
+            self._cancel_edit()
+        return super().yview(*args)
+
     def _on_double_click(self, event):
         region = self.identify("region", event.x, event.y)
         if region != "cell":
@@ -41,7 +206,8 @@ class EditableTreeview(ttk.Treeview):
         new_value = self._edit_box.get()
         values = list(self.item(row_id, "values"))
         values[col_index] = new_value
-        self.item(row_id, values=values)
+        # stored on the row, not only the item, so the edit survives scrolling
+        self.set_item_values(row_id, values)
         self._edit_box.destroy()
         self._edit_box = None
 
@@ -51,54 +217,376 @@ class EditableTreeview(ttk.Treeview):
             self._edit_box = None
 
 
+class ApiError(Exception):
+    pass
+
+class ConflictError(ApiError):
+    """The product was changed by someone else since we read it (HTTP 409)"""
+
+class BackgroundTask:
+    def __init__(self, description, owner, on_cancel=None):
+        self.description = description
+        self.owner = owner
+        self.on_cancel = on_cancel   # runs on the Tk thread instead of on_done/on_error once a cancelled task ends
+        self.cancelled = False
+        self.future = None
+
+    def cancel(self):
+        # a request already on the wire can't be stopped, its result is just dropped
+        self.cancelled = True
+        if self.future:
+            self.future.cancel()
+
+#the BackgroundWorker runs API calls on a thread pool. Tk is not thread safe, so results go through a
+#queue that the Tk thread polls with root.after, and callbacks always run on the Tk thread
+class BackgroundWorker:
+    def __init__(self, max_workers=WORKER_THREADS, poll_ms=WORKER_POLL_MS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="api")
+        self.results = queue.Queue()
+        self.poll_ms = poll_ms
+        self.tasks = []
+        self.lock = threading.Lock()
+        self.root = None
+        self.on_busy_change = None   # called with the running tasks whenever that list changes
+
+    def start(self, root):
+        self.root = root
+        self.root.after(self.poll_ms, self._poll)
+
+    def submit(self, func, *args, on_done=None, on_error=None, on_cancel=None, owner=None, description="Working"):
+        """Run func(*args) in the background, then on_done(result) or on_error(exception) on the Tk thread.
+        If `owner` (a window) is gone by then, the result is dropped; if the task was cancelled, on_cancel() runs"""
+        task = BackgroundTask(description, owner, on_cancel)
+        with self.lock:
+            self.tasks.append(task)
+        task.future = self.executor.submit(self._run, task, func, args, on_done, on_error or show_api_error)
+        # a task cancelled before it started never reaches _run, report it so it leaves the busy list
+        task.future.add_done_callback(lambda future: future.cancelled() and self.results.put((task, None, None)))
+        self._busy_changed()
+        return task
+
+    def _run(self, task, func, args, on_done, on_error):
+        if task.cancelled:
+            self.results.put((task, None, None))
+            return
+        try:
+            self.results.put((task, on_done, func(*args)))
+        except Exception as e:
+            self.results.put((task, on_error, e))
+
+    def _poll(self):
+        try:
+            while True:
+                try:
+                    task, callback, value = self.results.get_nowait()
+                except queue.Empty:
+                    break
+                with self.lock:
+                    self.tasks.remove(task)
+                self._busy_changed()
+                owner_gone = task.owner is not None and not task.owner.winfo_exists()
+                if task.cancelled:
+                    # the result is dropped, but whoever is waiting for it still has to hear it ended
+                    if task.on_cancel:
+                        self._callback(task.on_cancel)
+                elif callback and not owner_gone:
+                    self._callback(callback, value)
+        finally:
+            # a failing callback must not stop the polling, every later result would be lost
+            self.root.after(self.poll_ms, self._poll)
+
+    def _callback(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            # same report Tk gives an exception raised in one of its own callbacks
+            self.root.report_callback_exception(*sys.exc_info())
+
+    def _busy_changed(self):
+        if self.on_busy_change:
+            with self.lock:
+                tasks = [task for task in self.tasks if not task.cancelled]
+            self.on_busy_change(tasks)
+
+    def cancel_all(self):
+        with self.lock:
+            tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        self._busy_changed()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+#the ApiClient sends every call through one keep-alive session, so repeated calls reuse open connections
+#instead of setting up a new TCP connection each time
+class ApiClient:
+    def __init__(self, base_url=API_URL, timeout=(API_CONNECT_TIMEOUT, API_READ_TIMEOUT),
+                 retries=API_RETRIES, backoff=API_RETRY_BACKOFF, pool_size=WORKER_THREADS):
+        self.base_url = base_url
+        self.timeout = timeout
+        # POST is not retried on a bad status: creating or restocking twice is not harmless. Neither is
+        # PUT: updates carry If-Match, so a retry of one that did commit would come back as a false 409.
+        # Connection errors are still retried for every method, those requests never reached the server
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset({"GET", "HEAD", "DELETE"}), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # the API compresses big listings and exports, requests decompresses them on its own
+        # (its default list includes br when the brotli package is installed)
+        self.session.headers["Accept-Encoding"] = requests.utils.DEFAULT_ACCEPT_ENCODING
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        try:
+            return self.session.request(method, self.base_url + path, **kwargs)
+        except requests.RequestException as e:
+            raise ApiError(f"{method} {path}: {e}") from e
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+#the ProductStore is the local copy of the catalog every window reads from. It is loaded once and
+#then kept current with /changes/, which only returns what was inserted, updated or deleted since
+class ProductStore:
+    def __init__(self, max_age=STORE_MAX_AGE):
+        self.max_age = max_age
+        self.version = 0
+        self.last_refresh = None
+        self.refreshing = False
+        self.stale_after_refresh = False
+        self.waiting = []           # callbacks for when the running refresh finishes
+        self.products = {}          # product_id -> product
+        self.by_name = {}           # lowercase name -> set of product_ids
+        self.in_stock = set()
+        self.out_of_stock = set()
+
+    def _add(self, product):
+        product_id = product["product_id"]
+        self.products[product_id] = product
+        self.by_name.setdefault((product["product_name"] or "").lower(), set()).add(product_id)
+        if (product["product_stock"] or 0) > 0:
+            self.in_stock.add(product_id)
+        else:
+            self.out_of_stock.add(product_id)
+
+    def _remove(self, product_id):
+        product = self.products.pop(product_id, None)
+        if product is None:
+            return
+        name = (product["product_name"] or "").lower()
+        self.by_name[name].discard(product_id)
+        if not self.by_name[name]:
+            del self.by_name[name]
+        self.in_stock.discard(product_id)
+        self.out_of_stock.discard(product_id)
+
+    def apply(self, changes):
+        if changes["reset"]:
+            self.products, self.by_name = {}, {}
+            self.in_stock, self.out_of_stock = set(), set()
+        for product_id in changes["deletes"]:
+            self._remove(product_id)
+        for product in changes["upserts"]:
+            self._remove(product["product_id"])
+            self._add(product)
+        self.version = changes["version"]
+
+    def refresh(self, on_ready=None):
+        """Fetch what changed since the last refresh in the background, then call on_ready()"""
+        if on_ready:
+            self.waiting.append(on_ready)
+        # several windows asking at once share one request
+        if self.refreshing:
+            return
+        self.refreshing = True
+        worker.submit(fetch_changes, self.version, on_done=self._refreshed, on_error=self._refresh_failed,
+                      on_cancel=self._refresh_cancelled, description="Refreshing products")
+
+    def _refreshed(self, pages):
+        self.refreshing = False
+        for changes in pages:
+            self.apply(changes)
+        # a write that finished while the request was out may not be in it
+        self.last_refresh = None if self.stale_after_refresh else time.monotonic()
+        self.stale_after_refresh = False
+        callbacks, self.waiting = self.waiting, []
+        for callback in callbacks:
+            callback()
+
+    def _refresh_failed(self, error):
+        self.refreshing = False
+        self.waiting = []
+        show_api_error(error)
+
+    def _refresh_cancelled(self):
+        # Cancel on the busy bar: drop the windows waiting for it, the next ensure_fresh starts a new refresh
+        self.refreshing = False
+        self.waiting = []
+
+    def ensure_fresh(self, on_ready):
+        # windows opened in quick succession share one refresh
+        if self.last_refresh is None or time.monotonic() - self.last_refresh > self.max_age:
+            self.refresh(on_ready)
+        else:
+            on_ready()
+
+    def invalidate(self):
+        # called after our own writes, so the next read picks them up
+        self.last_refresh = None
+        self.stale_after_refresh = self.refreshing
+
+    def get(self, product_id):
+        try:
+            return self.products.get(int(product_id))
+        except (TypeError, ValueError):
+            return None
+
+    def find_by_name(self, name):
+        return self._sorted(self.by_name.get(name.lower(), ()))
+
+    def all(self):
+        return self._sorted(self.products)
+
+    def available(self):
+        return self._sorted(self.in_stock)
+
+    def unavailable(self):
+        return self._sorted(self.out_of_stock)
+
+    def _sorted(self, product_ids):
+        return [self.products[product_id] for product_id in sorted(product_ids)]
+
+api = ApiClient()
+worker = BackgroundWorker()
+product_store = ProductStore()
+
+def while_open(window, callback):
+    # for store callbacks: skip them if the window was closed while waiting
+    return lambda: callback() if window.winfo_exists() else None
+
+
 #.................FUNCTIONS TO RUN APIS............................
+# these run on the background worker: no widgets or message boxes here, failures raise ApiError
+
+def check_response(response, action):
+    if response.status_code == 409:
+        raise ConflictError(f"{action} failed: {response.json().get('detail')}")
+    if response.status_code != 200:
+        raise ApiError(f"{action} failed ({response.status_code}): {response.text}")
+    return response
+
+def send_create_product(product):
+    check_response(api.post("/create_product/", json=product), "Create product")
+
+def columns_to_products(columns):
+    # layout=columns sends every field name once with an array of values, turn it back into product dicts
+    fields = list(columns)
+    return [dict(zip(fields, values)) for values in zip(*columns.values())]
+
+def fetch_changes(since):
+    # a page at a time: each one continues from the version the previous one ended at
+    pages = []
+    while True:
+        response = api.get("/changes/", params={"since": since, "limit": PAGE_SIZE, "layout": "columns"})
+        page = check_response(response, "Fetch changes").json()
+        page["upserts"] = columns_to_products(page["upserts"])
+        pages.append(page)
+        if not page["more"]:
+            return pages
+        since = page["version"]
+
+def send_update_product(product_id, product, version=None):
+    # with the version we read, the server refuses (409) to overwrite someone else's newer change
+    headers = {"If-Match": f'"{version}"'} if version is not None else {}
+    response = api.put(f"/update_product/{product_id}", json=product, headers=headers)
+    return check_response(response, "Update product").json()
+
+def send_delete_product(product_id):
+    check_response(api.delete(f"/delete_product/{product_id}"), "Delete product")
+
+def find_products(search_term, limit=SEARCH_PAGE_SIZE, offset=0):
+    response = api.get(f"/find_products/{quote(search_term, safe='')}", params={"limit": limit, "offset": offset})
+    return check_response(response, "Search").json()
+
+def find_products_by_field(field,search_term,operator="contains",upper=None,limit=SEARCH_PAGE_SIZE,offset=0):
+    params = {"op": operator, "limit": limit, "offset": offset}
+    if upper:
+        params["upper"] = upper
+    response = api.get(f"/find_product_by_field/{field}/{quote(search_term, safe='')}", params=params)
+    return check_response(response, "Search").json()
+
+def send_restock(restock_items):
+    # restock_items is a list of {"product_id": ..., "stock_delta": ...}, sent in one request
+    response = api.post("/restock_products/", json=restock_items)
+    return check_response(response, "Restock").json()
 
-def create_product(name,description,price,stock):
+def get_stats():
+    headers = {"If-None-Match": last_stats["etag"]} if last_stats["etag"] else {}
+    response = api.get("/get_stats/", headers=headers)
+    if response.status_code == 304:
+        return last_stats["stats"]
+    check_response(response, "Fetch statistics")
+    last_stats["etag"] = response.headers.get("ETag")
+    last_stats["stats"] = response.json()
+    return last_stats["stats"]
+
+
+#.................ACTIONS (read the form, call the API in the background)............................
+# writes have no owner window: their result is handled even if the form was closed meanwhile,
+# the product store still has to be invalidated
+
+def show_api_error(error):
+    messagebox.showerror("Error", f"API Error: {error}")
+
+def create_product(name,description,price,stock,window):
     product_name=name.get()
     product_description=description.get()
     product_price=price.get()
     product_stock=stock.get()
 
     if not product_name or not product_price or not product_stock:
-        messagebox.showwarning("Input Error", "Please fill all necessary fields.")
+        messagebox.showwarning("Input Error", "Please fill all necessary fields.", parent=window)
         return
 
-    try:
-        product={
-            "product_name": product_name,
-            "product_description": product_description,
-            "product_price": product_price,
-            "product_stock": product_stock,
-        }
+    product={
+        "product_name": product_name,
+        "product_description": product_description,
+        "product_price": product_price,
+        "product_stock": product_stock,
+    }
 
-        response = requests.post(f"{API_URL}/create_product/", json=product)
-        if response.status_code == 200:
-            messagebox.showinfo("Success", "Product created successfully")
-        else:
-            messagebox.showerror("Error", f"API Error: {response.text}")
-    except Exception as e:
-        messagebox.showerror("Error", f"API Error: {e}")
+    def on_created(_):
+        product_store.invalidate()
+        messagebox.showinfo("Success", "Product created successfully")
+        window.destroy()
 
-def fetch_products():
-    try:
-        response = requests.get(f"{API_URL}/get_products/")
-        if response.status_code == 200:
-            return response.json()
-        else:
-            messagebox.showerror("Error", f"Failed to fetch products: {response.text}")
-            return []
-    except Exception as e:
-        messagebox.showerror("Error", f"API Error: {e}")
-        return []
+    worker.submit(send_create_product, product, on_done=on_created, description="Creating product")
 
-def update_product(product_id,name,description,price,stock,window,refresh_callback=None):
+def update_product(product_id,name,description,price,stock,window,refresh_callback=None,version=None):
     product_name=name.get()
     product_description=description.get()
     product_price=price.get()
     product_stock=stock.get()
 
     if not product_name or not product_price or not product_stock:
-        messagebox.showerror("Input Error","Please fill all necessary fields.")
+        messagebox.showerror("Input Error","Please fill all necessary fields.", parent=window)
         return
 
     try:
@@ -108,111 +596,78 @@ def update_product(product_id,name,description,price,stock,window,refresh_callba
             "product_price": float(product_price),
             "product_stock": int(product_stock),
         }
-        response = requests.put(f"{API_URL}/update_product/{product_id}/", json=product_data)
-        if response.status_code == 200:
-            messagebox.showinfo("Success", "Product updated successfully")
-            window.destroy()
-            if refresh_callback:
-                refresh_callback()
-        else:
-            messagebox.showerror("Error", f"API Error: {response.text}")
-    except Exception as e:
-        messagebox.showerror("Error", f"API Error: {e}")
-
-def delete_product(product_id,window,refresh_callback=None):
-    result=messagebox.askyesno("Confirm deletion","Are you sure you want to delete this product?")
-    if not result:
+    except ValueError:
+        messagebox.showerror("Input Error", "Price must be a number and stock a whole number.", parent=window)
         return
-    try:
-        response = requests.delete(f"{API_URL}/delete_product/{product_id}/")
-        if response.status_code == 200:
-            messagebox.showinfo("Success", "Product deleted successfully")
-            window.destroy()
-            if refresh_callback:
-                refresh_callback()
-        else:
-            messagebox.showerror("Error", f"API Error: {response.text}")
-    except Exception as e:
-        messagebox.showerror("Error", f"API Error: {e}")
 
-def find_products(search_term):
-    try:
-        response=requests.get(f'{API_URL}/find_products/{search_term}/')
-        if response.status_code == 200:
-            return response.json()
-        else:
-            messagebox.showerror("Error", f"API Error: {response.text}")
-            return []
-    except Exception as e:
-        messagebox.showerror("Error", f"API Error: {e}")
-        return []
+    def on_updated(_):
+        product_store.invalidate()
+        messagebox.showinfo("Success", "Product updated successfully")
+        window.destroy()
+        if refresh_callback:
+            refresh_callback()
 
-def find_products_by_field(field,search_term):
-    try:
-        response=requests.get(f'{API_URL}/find_product_by_field/{field}/{search_term}/')
-        if response.status_code == 200:
-            return response.json()
-        else:
-            messagebox.showerror("Error", f"API Error: {response.text}")
-            return []
-    except Exception as e:
-        messagebox.showerror("Error", f"API Error: {e}")
-        return []
-
-def restock_products(restocked_products, window=None, refresh_callback=None):
-    for product in restocked_products:
-        # Extract product data from dict
-        product_id = product.get("product_id")
-        product_name = product.get("product_name")
-        product_description = product.get("product_description")
-        product_price = product.get("product_price")
-        product_stock = product.get("product_stock")
-
-        # Validation
-        if not all([product_name, product_description, product_price, product_stock]):
-            messagebox.showerror("Input Error", "Please fill all necessary fields.")
+    def on_error(error):
+        if not isinstance(error, ConflictError):
+            show_api_error(error)
             return
+        # keep the form open with the user's input, the lists are refreshed to show the other change
+        product_store.invalidate()
+        messagebox.showwarning("Update conflict", "This product was changed by someone else after you opened it.\n"
+                               "Close this window and open the product again to see the current values.")
+        if refresh_callback:
+            refresh_callback()
 
-        try:
-            product_data = {
-                "product_name": product_name,
-                "product_description": product_description,
-                "product_price": float(product_price),
-                "product_stock": int(product_stock),
-            }
+    worker.submit(send_update_product, product_id, product_data, version, on_done=on_updated, on_error=on_error,
+                  description="Updating product")
 
-            response = requests.put(f"{API_URL}/update_product/{product_id}/", json=product_data)
+def delete_product(product_id,window,refresh_callback=None):
+    result=messagebox.askyesno("Confirm deletion","Are you sure you want to delete this product?", parent=window)
+    if not result:
+        return
 
-            if response.status_code == 200:
-                print(f"Product {product_name} updated successfully.")
-            else:
-                messagebox.showerror("Error", f"API Error ({response.status_code}): {response.text}")
+    def on_deleted(_):
+        product_store.invalidate()
+        messagebox.showinfo("Success", "Product deleted successfully")
+        window.destroy()
+        if refresh_callback:
+            refresh_callback()
 
-        except Exception as e:
-            messagebox.showerror("Error", f"API Error: {e}")
+    worker.submit(send_delete_product, product_id, on_done=on_deleted, description="Deleting product")
 
-    # Optional cleanup after all updates
-    messagebox.showinfo("Success", "All products updated successfully.")
-    if window:
-        window.destroy()
-    if refresh_callback:
-        refresh_callback()
+def restock_products(restock_items, window=None, refresh_callback=None):
+    if not restock_items:
+        messagebox.showinfo("Restock", "No additions to apply.", parent=window)
+        return
 
-def get_stats():
-    try:
-        response = requests.get(f"{API_URL}/get_stats/")
-        if response.status_code == 200:
-            return response.json()
-        else:
-            messagebox.showerror("Error", f"Failed to fetch products: {response.text}")
-            return []
-    except Exception as e:
-        messagebox.showerror("Error", f"API Error: {e}")
-        return []
+    def on_restocked(result):
+        product_store.invalidate()
+        if result["missing"]:
+            messagebox.showwarning("Restock", f"Products not found: {', '.join(map(str, result['missing']))}")
+        messagebox.showinfo("Success", f"{len(result['updated'])} products restocked successfully.")
+        if window:
+            window.destroy()
+        if refresh_callback:
+            refresh_callback()
+
+    worker.submit(send_restock, restock_items, on_done=on_restocked, description="Restocking")
 
 
 #............... FRONT END VISUALIZATION........................
 
+def product_row(product, *extra):
+    """A product as a VirtualTreeview row, negative stock gets the 'negative' tag"""
+    stock_value = product.get('product_stock', 0)
+    tags = ('negative',) if stock_value is not None and stock_value < 0 else ()
+    values = (
+        product.get('product_id', 'N/A'),
+        product.get('product_name', 'N/A'),
+        product.get('product_description', 'N/A'),
+        product.get('product_price', 'N/A'),
+        stock_value,
+    ) + extra
+    return product.get('product_id'), values, tags
+
 def open_create_product():
     window = tk.Toplevel(root)
     ttk.Label(window, text="Create a new product", font=("Arial", 14, "bold")).pack(pady=10)
@@ -243,10 +698,10 @@ def open_create_product():
         foreground="red"
     ).pack(pady=10)
 
-    # FIX: Use lambda to prevent immediate execution
+    # FIX: Use lambda to prevent immediate execution. The window closes once the product is created
     ttk.Button(button_frame, text="Create Product",
-               command=lambda: [create_product(product_name_entry, product_description_entry,
-                                           product_price_entry, product_stock_entry),window.destroy()]).pack(side="left", padx=10)
+               command=lambda: create_product(product_name_entry, product_description_entry,
+                                              product_price_entry, product_stock_entry, window)).pack(side="left", padx=10)
     ttk.Button(button_frame, text="Back",
                command=window.destroy).pack(side="left", padx=10)
 
@@ -255,15 +710,6 @@ def open_view_products():
     window.title("View Products")
     window.geometry("1200x600")
 
-    #First we get our data from database
-    products = fetch_products()
-    if not products:
-        messagebox.showerror("Error","No products found")
-        return []
-
-    products_in_stock = [p for p in products if p.get('product_stock', 0)>0]
-    products_out_of_stock = [p for p in products if p.get('product_stock',0)<=0]
-
     #We create the parent frame for both tables
     main_frame = ttk.Frame(window)
     main_frame.pack(fill="both",expand=True,padx=10,pady=10)
@@ -275,7 +721,7 @@ def open_view_products():
     ttk.Label(available_frame,text="Available Products",font=("Arial",13,"bold")).pack(pady=10)
 
 
-    available_tree = ttk.Treeview(available_frame, columns=("ID","Name","Description","Price","Stock"),show="headings", height=10)
+    available_tree = VirtualTreeview(available_frame, columns=("ID","Name","Description","Price","Stock"),show="headings", height=10)
     available_tree.heading("ID", text="ID", anchor="center")
     available_tree.heading("Name", text="Product Name", anchor="center")
     available_tree.heading("Description", text="Description", anchor="center")
@@ -287,8 +733,8 @@ def open_view_products():
     available_tree.column("Price", width=100, anchor="center")
     available_tree.column("Stock", width=80, anchor="center")
 
-    available_scrollbar=ttk.Scrollbar(available_frame,orient="vertical",command=available_tree.yview)
-    available_tree.configure(yscrollcommand=available_scrollbar.set)
+    available_scrollbar=ttk.Scrollbar(available_frame,orient="vertical")
+    available_tree.attach_scrollbar(available_scrollbar)
 
     available_tree.pack(side="left", fill="both",expand=True)
     available_scrollbar.pack(side="right", fill="y")
@@ -298,7 +744,7 @@ def open_view_products():
     out_of_stock_frame.grid(row=1,column=1,sticky="nsew")
     ttk.Label(out_of_stock_frame,text="Out of Stock Products",font=("Arial",13,"bold")).pack(pady=10)
 
-    out_of_stock_tree=ttk.Treeview(out_of_stock_frame, columns=("ID", "Name", "Description", "Price", "Stock"), show="headings", height=10)
+    out_of_stock_tree=VirtualTreeview(out_of_stock_frame, columns=("ID", "Name", "Description", "Price", "Stock"), show="headings", height=10)
 
     out_of_stock_tree.heading("ID", text="ID", anchor="center")
     out_of_stock_tree.heading("Name", text="Product Name", anchor="center")
@@ -311,8 +757,8 @@ def open_view_products():
     out_of_stock_tree.column("Price", width=100, anchor="center")
     out_of_stock_tree.column("Stock", width=80, anchor="center")
 
-    out_of_stock_scrollbar = ttk.Scrollbar(out_of_stock_frame, orient="vertical", command=out_of_stock_tree.yview)
-    out_of_stock_tree.configure(yscrollcommand=out_of_stock_scrollbar.set)
+    out_of_stock_scrollbar = ttk.Scrollbar(out_of_stock_frame, orient="vertical")
+    out_of_stock_tree.attach_scrollbar(out_of_stock_scrollbar)
 
     out_of_stock_tree.pack(side="left", fill="both", expand=True)
     out_of_stock_scrollbar.pack(side="right", fill="y")
@@ -325,67 +771,22 @@ def open_view_products():
     # Define tag for negative stock (red color)
     out_of_stock_tree.tag_configure('negative', foreground='red')
 
-    #And now we populate our trees
-    for product in products_in_stock:
-        available_tree.insert("","end",values=(
-            product.get('product_id', 'N/A'),
-            product.get('product_name', 'N/A'),
-            product.get('product_description', 'N/A'),
-            product.get('product_price', 'N/A'),
-            product.get('product_stock', 'N/A')
-        ))
-
-    for product in products_out_of_stock:
-        stock_value = product.get('product_stock', 0)
-        tags = ('negative',) if stock_value < 0 else ()
-        out_of_stock_tree.insert("","end",values=(
-            product.get('product_id', 'N/A'),
-            product.get('product_name', 'N/A'),
-            product.get('product_description', 'N/A'),
-            product.get('product_price', 'N/A'),
-            product.get('product_stock', 'N/A')
-        ),tags=tags)
+    def populate_tables():
+        """Fill both tables from the product store"""
+        if not product_store.products:
+            messagebox.showerror("Error","No products found", parent=window)
+
+        # The store already keeps products separated by stock. On a refresh only the rows
+        # on screen that changed are redrawn, and the scroll position stays where it was
+        available_tree.set_rows(product_row(p) for p in product_store.available())
+        out_of_stock_tree.set_rows(product_row(p) for p in product_store.unavailable())
 
     def refresh_tables():
-        """Refresh both tables with updated data"""
-        # Clear existing data
-        for tree in [available_tree, out_of_stock_tree]:
-            for item in tree.get_children():
-                tree.delete(item)
-
-        # Fetch updated products
-        products = fetch_products()
-        if not products:
-            return
+        """Refresh both tables with updated data, only the changes since the last refresh are fetched"""
+        product_store.refresh(while_open(window, populate_tables))
 
-        # Separate products
-        available_products = [p for p in products if p.get('product_stock', 0) > 0]
-        out_of_stock_products = [p for p in products if p.get('product_stock', 0) <= 0]
-
-        # Populate tables with updated data
-        for product in available_products:
-            stock_value = product.get('product_stock', 0)  # FIXED: Define stock_value here
-            tags = ('negative',) if stock_value < 0 else ()
-
-            available_tree.insert("", "end", values=(
-                product.get('product_id', 'N/A'),
-                product.get('product_name', 'N/A'),
-                product.get('product_description', 'N/A'),
-                product.get('product_price', 'N/A'),
-                stock_value
-            ), tags=tags)
-
-        for product in out_of_stock_products:
-            stock_value = product.get('product_stock', 0)  # FIXED: Define stock_value here
-            tags = ('negative',) if stock_value < 0 else ()
-
-            out_of_stock_tree.insert("", "end", values=(
-                product.get('product_id', 'N/A'),
-                product.get('product_name', 'N/A'),
-                product.get('product_description', 'N/A'),
-                product.get('product_price', 'N/A'),
-                stock_value
-            ), tags=tags)
+    # The tables are filled once the store is current, the window stays responsive meanwhile
+    product_store.ensure_fresh(while_open(window, populate_tables))
 
     # Add double-click bindings
     available_tree.bind("<Double-1>", lambda e: on_double_click(e, available_tree, refresh_tables))
@@ -436,7 +837,8 @@ def open_edit_product(product_data,refresh_callback=None):
                    product_price_entry,
                    product_stock_entry,
                    window,
-                   refresh_callback
+                   refresh_callback,
+                   product_data.get('product_version')
                )).pack(side="left", padx=10)
     ttk.Button(button_frame, text="Cancel",
                command=window.destroy).pack(side="left", padx=10)
@@ -469,6 +871,10 @@ def on_double_click(event, tree, refresh_callback=None):
             'product_price': float(values[3]),
             'product_stock': int(values[4])
         }
+        # the version the table shows, so the update can't silently overwrite a newer change
+        product = product_store.get(values[0])
+        if product:
+            product_data['product_version'] = product.get('product_version')
         open_edit_product(product_data, refresh_callback)
 
 def open_search_window():
@@ -498,7 +904,8 @@ def open_search_window():
     ttk.Label(all_search_frame, text="Search All Fields:",
               font=("Arial", 10, "bold")).grid(row=0, column=0, padx=(0, 15), sticky="w")
 
-    all_search_entry = ttk.Entry(all_search_frame, width=40, font=("Arial", 10))
+    all_search_var = tk.StringVar()
+    all_search_entry = ttk.Entry(all_search_frame, width=40, font=("Arial", 10), textvariable=all_search_var)
     all_search_entry.grid(row=0, column=1, padx=(0, 15))
 
     ttk.Button(all_search_frame, text="Search All",
@@ -521,12 +928,27 @@ def open_search_window():
     field_combobox.grid(row=0, column=1, padx=(0, 15))
     field_combobox.set("product_name")  # Default field
 
-    field_search_entry = ttk.Entry(field_search_frame, width=40, font=("Arial", 10))
-    field_search_entry.grid(row=0, column=2, padx=(0, 15))
+    operator_combobox = ttk.Combobox(field_search_frame,
+                                     values=["contains", "prefix", "=", "<", "<=", ">", ">=", "between"],
+                                     state="readonly",
+                                     width=8,
+                                     font=("Arial", 10))
+    operator_combobox.grid(row=0, column=2, padx=(0, 10))
+    operator_combobox.set("contains")  # Default operator
+
+    field_search_var = tk.StringVar()
+    field_search_entry = ttk.Entry(field_search_frame, width=20, font=("Arial", 10), textvariable=field_search_var)
+    field_search_entry.grid(row=0, column=3, padx=(0, 5))
+
+    # Upper value, only used by "between"
+    ttk.Label(field_search_frame, text="and").grid(row=0, column=4, padx=(0, 5))
+    upper_search_var = tk.StringVar()
+    upper_search_entry = ttk.Entry(field_search_frame, width=10, font=("Arial", 10), textvariable=upper_search_var)
+    upper_search_entry.grid(row=0, column=5, padx=(0, 15))
 
     ttk.Button(field_search_frame, text="Search Field",
                command=lambda: perform_search_field(),
-               width=12).grid(row=0, column=3)
+               width=12).grid(row=0, column=6)
 
     # --- Quick Action Buttons (Row 3) ---
     action_frame = ttk.Frame(control_frame)
@@ -535,12 +957,14 @@ def open_search_window():
     ttk.Button(action_frame, text="Show All Products",
                command=lambda: [all_search_entry.delete(0, tk.END),
                                 field_search_entry.delete(0, tk.END),
+                                upper_search_entry.delete(0, tk.END),
                                 load_all_products()],
                width=18).pack(side="left", padx=(0, 10))
 
     ttk.Button(action_frame, text="Clear All",
                command=lambda: [all_search_entry.delete(0, tk.END),
-                                field_search_entry.delete(0, tk.END)],
+                                field_search_entry.delete(0, tk.END),
+                                upper_search_entry.delete(0, tk.END)],
                width=12).pack(side="left")
 
     # Back button
@@ -551,7 +975,7 @@ def open_search_window():
     results_label_frame.pack(fill="both", expand=True)
 
     columns = ("ID", "Name", "Description", "Price", "Stock")
-    tree = ttk.Treeview(results_label_frame, columns=columns, show="headings", height=12)
+    tree = VirtualTreeview(results_label_frame, columns=columns, show="headings", height=12)
 
     tree.column("ID", width=60, anchor="center")
     tree.column("Name", width=150, anchor="center")
@@ -564,8 +988,8 @@ def open_search_window():
         tree.heading(col, text=col, anchor="center")
 
     # Add scrollbar
-    scrollbar = ttk.Scrollbar(results_label_frame, orient="vertical", command=tree.yview)
-    tree.configure(yscrollcommand=scrollbar.set)
+    scrollbar = ttk.Scrollbar(results_label_frame, orient="vertical")
+    tree.attach_scrollbar(scrollbar)
 
     # Pack tree and scrollbar
     tree.pack(side="left", fill="both", expand=True)
@@ -582,61 +1006,132 @@ def open_search_window():
                              font=("Arial", 9), foreground="gray")
     status_label.pack(side="left")
 
-    def populate_tree(products, search_type=""):
-        # Clear old data
-        for item in tree.get_children():
-            tree.delete(item)
+    load_more_button = ttk.Button(status_frame, text="Load more", state="disabled",
+                                  command=lambda: load_more())
+    load_more_button.pack(side="right")
 
-        if not products:
-            status_label.config(text="No products found for your search.")
-            messagebox.showinfo("No Results", "No products found for your search.")
-            return
+    # version of every product in the results, sent with updates made from this window
+    search_versions = {}
 
-        # Populate with products
-        for product in products:
-            stock_value = product.get('product_stock', 0)
-            tags = ('negative',) if stock_value < 0 else ()
+    def populate_tree(products, search_type="", append=False, notify=True):
+        # Replace old data (back at the top), unless these are the next results of the same search
+        rows = [product_row(product) for product in products]
+        if append:
+            tree.append_rows(rows)
+        else:
+            search_versions.clear()
+            tree.set_rows(rows, keep_position=False)
+        search_versions.update((product['product_id'], product.get('product_version')) for product in products)
 
-            tree.insert("", "end", values=(
-                product.get('product_id', 'N/A'),
-                product.get('product_name', 'N/A'),
-                product.get('product_description', 'N/A'),
-                product.get('product_price', 'N/A'),
-                stock_value
-            ), tags=tags)
+        if not products and not append:
+            status_label.config(text="No products found for your search.")
+            if notify:
+                messagebox.showinfo("No Results", "No products found for your search.", parent=window)
+            return
 
         # Update status
-        status_label.config(text=f"Found {len(products)} products" +
+        status_label.config(text=f"Found {len(tree.rows)} products" +
                                  (f" ({search_type})" if search_type else ""))
 
     # --- Search Functions ---
-    def perform_search_all():
+    # Only the latest search is shown: a new one cancels the request still running, and anything
+    # answered for an older search (generation) is dropped. Typing searches after a short pause
+    search_state = {"task": None, "generation": 0, "pending": None, "query": None, "offset": 0}
+
+    def start_new_search():
+        if search_state["pending"]:
+            window.after_cancel(search_state["pending"])
+            search_state["pending"] = None
+        if search_state["task"]:
+            search_state["task"].cancel()
+        search_state["generation"] += 1
+        load_more_button.config(state="disabled")
+        return search_state["generation"]
+
+    def run_search(func, args, search_type, notify=True, more=False):
+        if more:
+            if search_state["task"]:
+                search_state["task"].cancel()
+            generation, offset = search_state["generation"], search_state["offset"]
+            load_more_button.config(state="disabled")
+        else:
+            generation, offset = start_new_search(), 0
+            search_state["query"] = (func, args, search_type)
+        status_label.config(text="Searching...")
+
+        def on_done(products):
+            if generation != search_state["generation"]:
+                return
+            search_state["offset"] = offset + len(products)
+            populate_tree(products, search_type, append=more, notify=notify)
+            # a full page means there may be more
+            load_more_button.config(state="normal" if len(products) == SEARCH_PAGE_SIZE else "disabled")
+
+        def on_error(error):
+            if generation != search_state["generation"]:
+                return
+            # while typing, a half written value (e.g. "1." for a price) only shows up in the status bar
+            if notify:
+                status_label.config(text="Search failed.")
+                show_api_error(error)
+            else:
+                status_label.config(text=f"Search failed: {error}")
+
+        search_state["task"] = worker.submit(
+            func, *args, SEARCH_PAGE_SIZE, offset, on_done=on_done,
+            on_error=on_error, owner=window, description="Searching")
+
+    def load_more():
+        if search_state["query"] and str(load_more_button["state"]) == "normal":
+            func, args, search_type = search_state["query"]
+            run_search(func, args, search_type, notify=False, more=True)
+
+    def perform_search_all(notify=True):
         search_term = all_search_entry.get().strip()
         if not search_term:
-            messagebox.showwarning("Input Error", "Please enter a search term.")
+            if notify:
+                messagebox.showwarning("Input Error", "Please enter a search term.", parent=window)
             return
-        status_label.config(text="Searching...")
-        window.update()
-        products = find_products(search_term)
-        populate_tree(products, "all fields search")
+        # while typing, a single letter would match nearly everything
+        if not notify and len(search_term) < SEARCH_MIN_CHARS:
+            return
+        run_search(find_products, (search_term,), "all fields search", notify)
 
-    def perform_search_field():
+    def perform_search_field(notify=True):
         field = field_combobox.get()
+        operator = operator_combobox.get()
         search_term = field_search_entry.get().strip()
+        upper = upper_search_entry.get().strip()
         if not search_term:
-            messagebox.showwarning("Input Error", "Please enter a search term for the selected field.")
+            if notify:
+                messagebox.showwarning("Input Error", "Please enter a search term for the selected field.", parent=window)
             return
-        status_label.config(text="Searching...")
-        window.update()
-        products = find_products_by_field(field, search_term)
-        populate_tree(products, f"{field} search")
+        if operator == "between" and not upper:
+            if notify:
+                messagebox.showwarning("Input Error", "Please enter both values for a between search.", parent=window)
+            return
+        run_search(find_products_by_field, (field, search_term, operator, upper if operator == "between" else None),
+                   f"{field} {operator} search", notify)
+
+    def schedule_search(search_function):
+        # debounce: every change restarts the timer, the search runs once typing pauses
+        if search_state["pending"]:
+            window.after_cancel(search_state["pending"])
+        search_state["pending"] = window.after(SEARCH_DEBOUNCE_MS, lambda: search_function(notify=False))
 
     def load_all_products():
+        generation = start_new_search()
+        search_state["query"] = None
         status_label.config(text="Loading all products...")
-        window.update()
-        products = fetch_products()
-        populate_tree(products, "all products")
-        status_label.config(text=f"Loaded {len(products)} products")
+
+        def show_all():
+            if generation != search_state["generation"]:
+                return
+            products = product_store.all()
+            populate_tree(products, "all products")
+            status_label.config(text=f"Loaded {len(products)} products")
+
+        product_store.ensure_fresh(while_open(window, show_all))
 
     # --- Double Click to Edit Product ---
     def on_tree_double_click(event):
@@ -649,11 +1144,14 @@ def open_search_window():
             'product_name': values[1],
             'product_description': values[2],
             'product_price': float(values[3]),
-            'product_stock': int(values[4])
+            'product_stock': int(values[4]),
+            'product_version': search_versions.get(tree.row_key(item[0])),
         }
         open_edit_product(product_data, lambda: load_all_products())
 
     tree.bind("<Double-1>", on_tree_double_click)
+    # scrolling down to the last result loads the next page, like pressing "Load more"
+    tree.on_scroll_end = load_more
 
     # --- Bind Enter key to search ---
     def on_enter_key(event, search_function):
@@ -661,6 +1159,14 @@ def open_search_window():
 
     all_search_entry.bind("<Return>", lambda e: on_enter_key(e, perform_search_all))
     field_search_entry.bind("<Return>", lambda e: on_enter_key(e, perform_search_field))
+    upper_search_entry.bind("<Return>", lambda e: on_enter_key(e, perform_search_field))
+
+    # --- Search as you type ---
+    all_search_var.trace_add("write", lambda *args: schedule_search(perform_search_all))
+    field_search_var.trace_add("write", lambda *args: schedule_search(perform_search_field))
+    upper_search_var.trace_add("write", lambda *args: schedule_search(perform_search_field))
+    field_combobox.bind("<<ComboboxSelected>>", lambda e: schedule_search(perform_search_field))
+    operator_combobox.bind("<<ComboboxSelected>>", lambda e: schedule_search(perform_search_field))
 
     # Load all products initially
     load_all_products()
@@ -673,11 +1179,6 @@ def open_restock_window():
     window.title("Restock Products")
     window.geometry("680x600")
 
-    products = fetch_products()
-    if not products:
-        messagebox.showerror("Error", "No products found")
-        return []
-
     main_frame = ttk.Frame(window)
     main_frame.pack(fill="both", expand=True, padx=10, pady=10)
 
@@ -700,51 +1201,46 @@ def open_restock_window():
     products_tree.column("Stock", width=80, anchor="center")
     products_tree.column("Additions", width=80, anchor="center")
 
-    products_tree_scrollbar = ttk.Scrollbar(products_frame, orient="vertical", command=products_tree.yview)
-    products_tree.configure(yscrollcommand=products_tree_scrollbar.set)
+    products_tree_scrollbar = ttk.Scrollbar(products_frame, orient="vertical")
+    products_tree.attach_scrollbar(products_tree_scrollbar)
 
-    products_tree.pack(fill="both", expand=True)
-    products_tree.pack(side="right", fill="y")
+    products_tree.pack(side="left", fill="both", expand=True)
+    products_tree_scrollbar.pack(side="right", fill="y")
 
     # Define tag for negative stock (red color)
     products_tree.tag_configure('negative', foreground='red')
 
-    for product in products:
-        stock_value = product.get('product_stock', 0)  # FIXED: Define stock_value here
-        tags = ('negative',) if stock_value < 0 else ()
+    def populate_tree():
+        products = product_store.all()
+        if not products:
+            messagebox.showerror("Error", "No products found", parent=window)
+            return
 
-        products_tree.insert("", "end", values=(
-            product.get('product_id', 'N/A'),
-            product.get('product_name', 'N/A'),
-            product.get('product_description', 'N/A'),
-            product.get('product_price', 'N/A'),
-            stock_value,
-            0
-        ), tags=tags)
+        # every product starts with 0 additions
+        products_tree.set_rows(product_row(product, 0) for product in products)
+
+    product_store.ensure_fresh(while_open(window, populate_tree))
 
     def on_restock():
-        updated_products = []
-        for item_id in products_tree.get_children():
-            values = products_tree.item(item_id, "values")
-            stock = int(values[4])
-            additions = int(values[5])
-
-            new_stock = stock + additions
-            updated_products.append({
-                "product_id": values[0],
-                "product_name": values[1],
-                "product_description": values[2],
-                "product_price": values[3],
-                "product_stock": new_stock,
-            })
-        restock_products(updated_products, window)
+        # only the additions are sent, the server adds them to the current stock
+        restock_items = []
+        # all rows, not only the ones on screen
+        for _, values, _ in products_tree.rows:
+            try:
+                additions = int(values[5])
+            except ValueError:
+                messagebox.showerror("Input Error", f"Additions for {values[1]} must be a whole number.", parent=window)
+                return
+            if additions:
+                restock_items.append({"product_id": int(values[0]), "stock_delta": additions})
+        restock_products(restock_items, window)
 
     button_frame = ttk.Frame(window)
     button_frame.pack(pady=10)
 
-    # FIX: Use lambda to prevent immediate execution
+    # The window closes once the restock went through
     ttk.Button(button_frame, text="Restock Products",
-               command=lambda: [on_restock(),window.destroy()]).pack(side="left", padx=10)
+               command=on_restock).pack(side="left", padx=10)
     ttk.Button(button_frame, text="Back",
                command=window.destroy).pack(side="left", padx=10)
 
@@ -756,73 +1252,78 @@ def open_stats_window():
 
     ttk.Label(window, text="📊 Product Statistics", font=("Arial", 16, "bold")).pack(pady=15)
 
-    stats = get_stats()
-    if not stats:
-        ttk.Label(window, text="No statistics available", font=("Arial", 12)).pack(pady=20)
-        return
+    loading_label = ttk.Label(window, text="Loading statistics...", font=("Arial", 11), foreground="gray")
+    loading_label.pack(pady=10)
 
-    # Fetch all products to resolve product_id → product_name
-    products = fetch_products()
-    product_map = {str(p["product_id"]): p for p in products}
-
-    # Build readable labels
-    stat_labels = {
-        "product_count": "Total Products",
-        "average_price": "Average Price",
-        "average_stock": "Average Stock",
-        "highest_price_id": "Product with Highest Price",
-        "highest_price": "Highest Price",
-        "highest_stock_id": "Product with Highest Stock",
-        "highest_stock": "Highest Stock",
-        "value_sum": "Total Inventory Value",
-        "available_products": "Available Products",
-        "out_of_stock_products": "Out of Stock Products",
-    }
+    def show_stats(stats):
+        loading_label.destroy()
+        if not stats:
+            ttk.Label(window, text="No statistics available", font=("Arial", 12)).pack(pady=20)
+            return
+        # product_id → product_name comes from the local store instead of downloading the catalog
+        product_store.ensure_fresh(while_open(window, lambda: render_stats(stats)))
+
+    def render_stats(stats):
+        # Build readable labels
+        stat_labels = {
+            "product_count": "Total Products",
+            "average_price": "Average Price",
+            "average_stock": "Average Stock",
+            "highest_price_id": "Product with Highest Price",
+            "highest_price": "Highest Price",
+            "highest_stock_id": "Product with Highest Stock",
+            "highest_stock": "Highest Stock",
+            "value_sum": "Total Inventory Value",
+            "available_products": "Available Products",
+            "out_of_stock_products": "Out of Stock Products",
+        }
 
-    # Frame for all stat rows
-    stats_frame = ttk.Frame(window)
-    stats_frame.pack(padx=20, pady=10, fill="x")
+        # Frame for all stat rows
+        stats_frame = ttk.Frame(window)
+        stats_frame.pack(padx=20, pady=10, fill="x")
 
-    product_links = {}  # Keep references for clickable product labels
+        product_links = {}  # Keep references for clickable product labels
 
-    for i, (key, label_text) in enumerate(stat_labels.items()):
-        ttk.Label(stats_frame, text=label_text + ":", font=("Arial", 11, "bold")).grid(row=i, column=0, sticky="w", pady=5)
+        for i, (key, label_text) in enumerate(stat_labels.items()):
+            ttk.Label(stats_frame, text=label_text + ":", font=("Arial", 11, "bold")).grid(row=i, column=0, sticky="w", pady=5)
 
-        value = stats.get(key, "N/A")
+            value = stats.get(key, "N/A")
 
-        # Handle product ID fields
-        if key in ("highest_price_id", "highest_stock_id"):
-            product = product_map.get(str(value))
-            if product:
-                product_name = product["product_name"]
-                label = tk.Label(stats_frame, text=f"{product_name} (ID: {value})",
-                                 font=("Arial", 11), foreground="blue", cursor="hand2")
-                label.grid(row=i, column=1, sticky="w", pady=5)
-                # Store and bind double-click
-                product_links[label] = product
-                label.bind("<Double-1>", lambda e, p=product: open_edit_product(p))
-            else:
-                ttk.Label(stats_frame, text=f"Unknown (ID: {value})", font=("Arial", 11)).grid(row=i, column=1, sticky="w", pady=5)
+            # Handle product ID fields
+            if key in ("highest_price_id", "highest_stock_id"):
+                product = product_store.get(value)
+                if product:
+                    product_name = product["product_name"]
+                    label = tk.Label(stats_frame, text=f"{product_name} (ID: {value})",
+                                     font=("Arial", 11), foreground="blue", cursor="hand2")
+                    label.grid(row=i, column=1, sticky="w", pady=5)
+                    # Store and bind double-click
+                    product_links[label] = product
+                    label.bind("<Double-1>", lambda e, p=product: open_edit_product(p))
+                else:
+                    ttk.Label(stats_frame, text=f"Unknown (ID: {value})", font=("Arial", 11)).grid(row=i, column=1, sticky="w", pady=5)
 
-        else:
-            # Format numeric values nicely
-            if isinstance(value, (int, float)):
-                # Round all numeric values
-                value = round(float(value), 2)
-                if key in ("product_count","average_stock","highest_stock","available_products","out_of_stock_products"):
-                    value = round(int(value), 2)
-
-                # Add euro sign to price-related stats
-                if key in ("average_price", "highest_price", "value_sum"):
-                    display_value = f"{value:.2f} €"
+            else:
+                # Format numeric values nicely
+                if isinstance(value, (int, float)):
+                    # Round all numeric values
+                    value = round(float(value), 2)
+                    if key in ("product_count","average_stock","highest_stock","available_products","out_of_stock_products"):
+                        value = round(int(value), 2)
+
+                    # Add euro sign to price-related stats
+                    if key in ("average_price", "highest_price", "value_sum"):
+                        display_value = f"{value:.2f} €"
+                    else:
+                        display_value = str(value)
                 else:
                     display_value = str(value)
-            else:
-                display_value = str(value)
 
-            ttk.Label(stats_frame, text=display_value, font=("Arial", 11)).grid(row=i, column=1, sticky="w", pady=5)
+                ttk.Label(stats_frame, text=display_value, font=("Arial", 11)).grid(row=i, column=1, sticky="w", pady=5)
+
+        ttk.Button(window, text="Close", command=window.destroy).pack(pady=20)
 
-    ttk.Button(window, text="Close", command=window.destroy).pack(pady=20)
+    worker.submit(get_stats, on_done=show_stats, owner=window, description="Loading statistics")
 
 
 
@@ -844,6 +1345,32 @@ ttk.Button(root, text="Search Products", width=25, command=open_search_window).p
 ttk.Button(root, text="Restock Products", width=25, command=open_restock_window).pack(pady=5)
 ttk.Button(root, text="View Statistics", width=25, command=open_stats_window).pack(pady=5)
 
-ttk.Button(root, text="Exit", width=25, command=root.destroy).pack(pady=50)
-
-root.mainloop()
\ No newline at end of file
+ttk.Button(root, text="Exit", width=25, command=root.destroy).pack(pady=(30, 10))
+
+# Progress of the background API calls, with a way to give up on them
+busy_frame = ttk.Frame(root)
+busy_frame.pack(side="bottom", fill="x", padx=10, pady=10)
+busy_label = ttk.Label(busy_frame, text="", font=("Arial", 9), foreground="gray")
+busy_label.pack(side="left")
+busy_progress = ttk.Progressbar(busy_frame, mode="indeterminate", length=120)
+busy_cancel = ttk.Button(busy_frame, text="Cancel", command=worker.cancel_all)
+
+def show_busy(tasks):
+    if tasks:
+        busy_label.config(text=f"{tasks[-1].description}..." + (f" (+{len(tasks) - 1})" if len(tasks) > 1 else ""))
+        if not busy_progress.winfo_manager():
+            busy_cancel.pack(side="right")
+            busy_progress.pack(side="right", padx=5)
+            busy_progress.start(15)
+    else:
+        busy_label.config(text="")
+        busy_progress.stop()
+        busy_progress.pack_forget()
+        busy_cancel.pack_forget()
+
+worker.on_busy_change = show_busy
+worker.start(root)
+
+root.mainloop()
+worker.shutdown()
+api.close()
\ No newline at end of file